@@ -3,6 +3,8 @@ import pandas as pd
 import numpy as np
 from pathlib import Path
 import re
+import pyarrow as pa
+import pyarrow.parquet as pq
 from tqdm import tqdm
 
 # Constants
@@ -15,6 +17,16 @@ DEM_DIR = DATA_DIR / "usgs_dem"
 OUTPUT_FILE = DATA_DIR / "combined_data_sd.parquet"
 START_YEAR = 2000
 END_YEAR = 2024
+PRISM_VARS = ['ppt', 'tdmean', 'tmax', 'vpdmax']
+OUTPUT_COLUMNS = ['lat', 'lon', 'year', 'month', *PRISM_VARS,
+                  'burned_area', 'ndvi', 'landcover', 'elevation', 'slope', 'aspect']
+# Narrow integer keys, used from loading through the joins
+TIME_DTYPES = {'year': 'uint16', 'month': 'uint8'}
+# PRISM and NDVI rasters are float32; landcover class codes (<= 95) are
+# nullable uint8; the rest are float64 after NaN fill
+OUTPUT_DTYPES = {c: 'float64' for c in OUTPUT_COLUMNS}
+OUTPUT_DTYPES.update({c: 'float32' for c in [*PRISM_VARS, 'ndvi']})
+OUTPUT_DTYPES.update({'landcover': 'UInt8', **TIME_DTYPES})
 
 def get_prism_files(var_name):
     """
@@ -40,72 +52,91 @@ def get_prism_files(var_name):
             
     return sorted(files, key=lambda x: (x[1], x[2]))
 
-def verify_prism(df):
+def group_by_month(files):
     """
-    Verify PRISM data.
+    Group (file_path, year, month) tuples by (year, month).
     """
-    print("Verifying PRISM data...")
-    required_cols = ['ppt', 'tdmean', 'tmax', 'vpdmax']
-    for col in required_cols:
+    groups = {}
+    for entry in files:
+        groups.setdefault(entry[1:], []).append(entry)
+    return groups
+
+def flat_coord(values, shape, axis):
+    """
+    Value of the coordinate along `axis` for every element of a C-ordered array of the given shape
+    (the same row order as to_dataframe, without building a MultiIndex).
+    """
+    return np.tile(np.repeat(values, int(np.prod(shape[axis + 1:]))), int(np.prod(shape[:axis])))
+
+def load_stacked(files, column, time_cols, var_name=None):
+    """
+    Stack per-file grids along a time dimension and flatten them in one pass.
+    files is a list of (file_path, *time_cols) tuples.
+    Returns a DataFrame with lat, lon, *time_cols and the value column.
+    """
+    arrays = []
+    labels = []
+    for file_path, *label in files:
+        with xr.open_dataset(file_path) as ds:
+            name = var_name
+            if name is None:
+                # Filter out spatial_ref
+                data_vars = [v for v in ds.data_vars if v != 'spatial_ref']
+                name = data_vars[0] if data_vars else None
+            if name not in ds.data_vars:
+                print(f"Warning: Expected variable '{name}' not found in {file_path}. Variables: {list(ds.data_vars)}")
+                continue
+            arrays.append(ds[name].drop_vars('spatial_ref', errors='ignore').load())
+            labels.append(label)
+
+    if not arrays:
+        return pd.DataFrame(columns=['lat', 'lon', *time_cols, column]).astype({c: TIME_DTYPES[c] for c in time_cols})
+
+    # Files share one grid, so reuse the first file's coordinates
+    stacked = xr.concat(arrays, dim='time', join='override', coords='minimal', compat='override')
+    labels = np.array(labels, dtype=np.int64)
+    y_dim, x_dim = ('y', 'x') if 'y' in stacked.dims else ('lat', 'lon')
+    dims, shape = stacked.dims, stacked.shape
+
+    # Build the long frame column by column from the flat values
+    # (coordinates rounded to avoid floating point mismatch)
+    return pd.DataFrame({
+        'lat': flat_coord(stacked[y_dim].values.round(5), shape, dims.index(y_dim)),
+        'lon': flat_coord(stacked[x_dim].values.round(5), shape, dims.index(x_dim)),
+        **{c: flat_coord(labels[:, i].astype(TIME_DTYPES[c]), shape, dims.index('time')) for i, c in enumerate(time_cols)},
+        column: stacked.values.ravel(),
+    })
+
+def verify_prism(df, verbose=True, warn_nans=True):
+    """
+    Verify PRISM data. Returns True if any PRISM value is NaN.
+    With verbose=False only failures (and the NaN warning, if warn_nans) are printed.
+    """
+    if verbose:
+        print("Verifying PRISM data...")
+    for col in PRISM_VARS:
         if col not in df.columns:
             raise ValueError(f"Missing PRISM column: {col}")
     
-    if df.isnull().any().any():
+    # Column-wise and short-circuiting; only the PRISM values can be NaN
+    has_nans = any(df[col].isna().any() for col in PRISM_VARS)
+    if has_nans and warn_nans:
         print("Warning: NaNs found in PRISM data.")
     
-    print(f"PRISM data shape: {df.shape}")
-    print("PRISM verification passed.")
+    if verbose:
+        print(f"PRISM data shape: {df.shape}")
+        print("PRISM verification passed.")
+    return has_nans
 
-def load_and_process_prism():
+def load_and_process_prism(files_by_var):
     """
-    Load PRISM data (ppt, tdmean, tmax, vpdmax).
-    Returns a DataFrame indexed by (lat, lon, year, month).
+    Load PRISM data (ppt, tdmean, tmax, vpdmax) for the given files.
+    Returns a DataFrame with columns lat, lon, year, month and one per variable.
     """
-    print("Loading PRISM data...")
-    vars = ['ppt', 'tdmean', 'tmax', 'vpdmax']
     combined_df = None
     
-    for var in vars:
-        print(f"Processing {var}...")
-        files = get_prism_files(var)
-        var_dfs = []
-        
-        for file_path, year, month in tqdm(files, desc=f"Loading {var}"):
-            with xr.open_dataset(file_path) as ds:
-                df = ds.to_dataframe().reset_index()
-                
-                prism_var_map = {
-                    'ppt': 'Band1',
-                    'tdmean': 'Band1',
-                    'tmax': 'Band1',
-                    'vpdmax': 'Band1'
-                }
-                
-                target_col = prism_var_map.get(var)
-                if target_col and target_col in df.columns:
-                    df = df.rename(columns={target_col: var})
-                else:
-                    # Fallback or error if hardcoded name is missing
-                    print(f"Warning: Expected column '{target_col}' not found for {var} in {file_path}. Columns: {df.columns}")
-                    pass
-
-                df['year'] = year
-                df['month'] = month
-                
-                # Only need lat, lon, year, month, and the value
-                # Standardize lat/lon names if needed (y/x -> lat/lon)
-                if 'y' in df.columns and 'x' in df.columns:
-                    df = df.rename(columns={'y': 'lat', 'x': 'lon'})
-                
-                # Round coordinates to avoid floating point mismatch
-                df['lat'] = df['lat'].round(5)
-                df['lon'] = df['lon'].round(5)
-                
-                if var in df.columns:
-                    df = df[['lat', 'lon', 'year', 'month', var]]
-                    var_dfs.append(df)
-            
-        var_combined = pd.concat(var_dfs, ignore_index=True)
+    for var in PRISM_VARS:
+        var_combined = load_stacked(files_by_var.get(var, []), var, ['year', 'month'], var_name='Band1')
         
         if combined_df is None:
             combined_df = var_combined
@@ -113,18 +144,22 @@ def load_and_process_prism():
             # Merge on lat, lon, year, month
             combined_df = pd.merge(combined_df, var_combined, on=['lat', 'lon', 'year', 'month'], how='outer')
             
-    verify_prism(combined_df)
     return combined_df
 
-def verify_mtbs(df):
-    print("Verifying MTBS data...")
+def verify_mtbs(df, verbose=True):
+    if verbose:
+        print("Verifying MTBS data...")
     if 'burned_area' not in df.columns:
         raise ValueError("Missing MTBS column: burned_area")
-    print(f"MTBS data shape: {df.shape}")
-    print("MTBS verification passed.")
+    if verbose:
+        print(f"MTBS data shape: {df.shape}")
+        print("MTBS verification passed.")
 
-def load_and_process_mtbs():
-    print("Loading MTBS data...")
+def get_mtbs_files():
+    """
+    Get list of MTBS files and extract year-month.
+    Returns a list of tuples: (file_path, year, month)
+    """
     files = []
     # Pattern: sd_mtbs_800m_YYYYMM.nc
     pattern = re.compile(r"sd_mtbs_800m_(\d{4})(\d{2})\.nc$")
@@ -138,43 +173,25 @@ def load_and_process_mtbs():
                 files.append((file_path, year, month))
             
     files.sort(key=lambda x: (x[1], x[2]))
-    
-    dfs = []
-    for file_path, year, month in tqdm(files, desc="Loading MTBS"):
-        with xr.open_dataset(file_path) as ds:
-            df = ds.to_dataframe().reset_index()
-            # Rename variable
-            data_vars = list(ds.data_vars)
-            if data_vars:
-                df = df.rename(columns={data_vars[0]: 'burned_area'})
-            
-            df['year'] = year
-            df['month'] = month
-            
-            if 'y' in df.columns and 'x' in df.columns:
-                df = df.rename(columns={'y': 'lat', 'x': 'lon'})
-            
-            # Round coordinates
-            df['lat'] = df['lat'].round(5)
-            df['lon'] = df['lon'].round(5)
-                
-            if 'burned_area' in df.columns:
-                df = df[['lat', 'lon', 'year', 'month', 'burned_area']]
-                dfs.append(df)
-                
-    combined_df = pd.concat(dfs, ignore_index=True)
-    verify_mtbs(combined_df)
-    return combined_df
+    return files
 
-def verify_ndvi(df):
-    print("Verifying NDVI data...")
+def load_and_process_mtbs(files):
+    return load_stacked(files, 'burned_area', ['year', 'month'])
+
+def verify_ndvi(df, verbose=True):
+    if verbose:
+        print("Verifying NDVI data...")
     if 'ndvi' not in df.columns:
         raise ValueError("Missing NDVI column: ndvi")
-    print(f"NDVI data shape: {df.shape}")
-    print("NDVI verification passed.")
+    if verbose:
+        print(f"NDVI data shape: {df.shape}")
+        print("NDVI verification passed.")
 
-def load_and_process_ndvi():
-    print("Loading NDVI data...")
+def get_ndvi_files():
+    """
+    Get list of NDVI files and extract year-month.
+    Returns a list of tuples: (file_path, year, month)
+    """
     files = []
     # Pattern: sd_ndvi_800m_YYYY-MM-DD.nc
     pattern = re.compile(r"sd_ndvi_800m_(\d{4})-(\d{2})-(\d{2})\.nc$")
@@ -188,45 +205,25 @@ def load_and_process_ndvi():
                 files.append((file_path, year, month))
             
     files.sort(key=lambda x: (x[1], x[2]))
-    
-    dfs = []
-    for file_path, year, month in tqdm(files, desc="Loading NDVI"):
-        with xr.open_dataset(file_path) as ds:
-            df = ds.to_dataframe().reset_index()
-            data_vars = list(ds.data_vars)
-            # Filter out spatial_ref
-            data_vars = [v for v in data_vars if v != 'spatial_ref']
-            
-            if data_vars:
-                df = df.rename(columns={data_vars[0]: 'ndvi'})
-            
-            df['year'] = year
-            df['month'] = month
-            
-            if 'y' in df.columns and 'x' in df.columns:
-                df = df.rename(columns={'y': 'lat', 'x': 'lon'})
-            
-            # Round coordinates
-            df['lat'] = df['lat'].round(5)
-            df['lon'] = df['lon'].round(5)
-            
-            if 'ndvi' in df.columns:
-                df = df[['lat', 'lon', 'year', 'month', 'ndvi']]
-                dfs.append(df)
-    
-    combined_df = pd.concat(dfs, ignore_index=True)
-    verify_ndvi(combined_df)
-    return combined_df
+    return files
 
-def verify_nlcd(df):
-    print("Verifying NLCD data...")
+def load_and_process_ndvi(files):
+    return load_stacked(files, 'ndvi', ['year', 'month'])
+
+def verify_nlcd(df, verbose=True):
+    if verbose:
+        print("Verifying NLCD data...")
     if 'landcover' not in df.columns:
         raise ValueError("Missing NLCD column: landcover")
-    print(f"NLCD data shape: {df.shape}")
-    print("NLCD verification passed.")
+    if verbose:
+        print(f"NLCD data shape: {df.shape}")
+        print("NLCD verification passed.")
 
-def load_and_process_nlcd():
-    print("Loading NLCD data...")
+def get_nlcd_files():
+    """
+    Get list of NLCD files and extract year.
+    Returns a list of tuples: (file_path, year)
+    """
     files = []
     # Pattern: Annual_NLCD_LndCov_YYYY_CU_C1V1_800m.nc
     pattern = re.compile(r"Annual_NLCD_LndCov_(\d{4})_CU_C1V1_800m\.nc$")
@@ -240,33 +237,10 @@ def load_and_process_nlcd():
                 files.append((file_path, year))
             
     files.sort(key=lambda x: x[1])
-    
-    dfs = []
-    for file_path, year in tqdm(files, desc="Loading NLCD"):
-        with xr.open_dataset(file_path) as ds:
-            df = ds.to_dataframe().reset_index()
-            data_vars = list(ds.data_vars)
-            data_vars = [v for v in data_vars if v != 'spatial_ref']
-            
-            if data_vars:
-                df = df.rename(columns={data_vars[0]: 'landcover'})
-            
-            df['year'] = year
-            
-            if 'y' in df.columns and 'x' in df.columns:
-                df = df.rename(columns={'y': 'lat', 'x': 'lon'})
-            
-            # Round coordinates
-            df['lat'] = df['lat'].round(5)
-            df['lon'] = df['lon'].round(5)
-            
-            if 'landcover' in df.columns:
-                df = df[['lat', 'lon', 'year', 'landcover']]
-                dfs.append(df)
-                
-    combined_df = pd.concat(dfs, ignore_index=True)
-    verify_nlcd(combined_df)
-    return combined_df
+    return files
+
+def load_and_process_nlcd(files):
+    return load_stacked(files, 'landcover', ['year'])
 
 def verify_dem(df):
     print("Verifying DEM data...")
@@ -284,77 +258,129 @@ def load_and_process_dem():
         raise FileNotFoundError(f"DEM file not found: {file_path}")
         
     with xr.open_dataset(file_path) as ds:
-        df = ds.to_dataframe().reset_index()
+        y_dim, x_dim = ('y', 'x') if 'y' in ds.dims else ('lat', 'lon')
+        shape = (ds.sizes[y_dim], ds.sizes[x_dim])
         
-        if 'y' in df.columns and 'x' in df.columns:
-            df = df.rename(columns={'y': 'lat', 'x': 'lon'})
-            
-        # Round coordinates
-        df['lat'] = df['lat'].round(5)
-        df['lon'] = df['lon'].round(5)
-            
-        # Keep elevation, slope, aspect
-        cols = ['lat', 'lon', 'elevation', 'slope', 'aspect']
-        df = df[cols]
+        # Keep elevation, slope, aspect; build the frame column by column (coordinates rounded)
+        df = pd.DataFrame({
+            'lat': flat_coord(ds[y_dim].values.round(5), shape, 0),
+            'lon': flat_coord(ds[x_dim].values.round(5), shape, 1),
+            **{v: ds[v].transpose(y_dim, x_dim).values.ravel() for v in ['elevation', 'slope', 'aspect'] if v in ds.data_vars},
+        })
         
     verify_dem(df)
     return df
 
-def verify_final_output(df):
-    print("Verifying final combined DataFrame...")
-    required_cols = ['lat', 'lon', 'year', 'month', 'ppt', 'tdmean', 'tmax', 'vpdmax', 
-                     'burned_area', 'ndvi', 'landcover', 'elevation', 'slope', 'aspect']
+def grid_indexed(df, lat_values, lon_values, keys):
+    """
+    Replace float lat/lon with int32 row/column indices on the PRISM grid
+    and index the DataFrame by (iy, ix, *keys).
+    Coordinates that are not on the grid get -1 and never match.
+    """
+    iy = np.searchsorted(lat_values, df['lat'].to_numpy()).clip(max=len(lat_values) - 1)
+    ix = np.searchsorted(lon_values, df['lon'].to_numpy()).clip(max=len(lon_values) - 1)
+    iy = np.where(lat_values[iy] == df['lat'].to_numpy(), iy, -1).astype(np.int32)
+    ix = np.where(lon_values[ix] == df['lon'].to_numpy(), ix, -1).astype(np.int32)
+    df = df.drop(columns=['lat', 'lon']).assign(iy=iy, ix=ix)
+    return df.set_index(['iy', 'ix', *keys])
+
+def verify_final_output(parquet_file):
+    print("Verifying final combined Parquet file...")
+    columns = parquet_file.schema_arrow.names
     
-    missing = [c for c in required_cols if c not in df.columns]
+    missing = [c for c in OUTPUT_COLUMNS if c not in columns]
     if missing:
         raise ValueError(f"Missing columns in final output: {missing}")
         
-    print(f"Final DataFrame shape: {df.shape}")
+    print(f"Final output shape: ({parquet_file.metadata.num_rows}, {len(columns)})")
     print("Final verification passed.")
 
 def main():
-    # 1. Load PRISM (Base)
-    prism_df = load_and_process_prism()
-
-    print("PRISM Data:")
-    print(prism_df.describe())
-    
-    # 2. Load MTBS
-    mtbs_df = load_and_process_mtbs()
-
-    # Merge PRISM and MTBS
-    combined = pd.merge(prism_df, mtbs_df, on=['lat', 'lon', 'year', 'month'], how='left')
-    del prism_df, mtbs_df
-    
-    # 3. Load NDVI
-    ndvi_df = load_and_process_ndvi()
-
-    # Merge NDVI
-    combined = pd.merge(combined, ndvi_df, on=['lat', 'lon', 'year', 'month'], how='left')
-    del ndvi_df
+    # Index source files by (year, month) so one month is combined at a time
+    prism_files = {var: group_by_month(get_prism_files(var)) for var in PRISM_VARS}
+    mtbs_files = group_by_month(get_mtbs_files())
+    ndvi_files = group_by_month(get_ndvi_files())
+    nlcd_files = group_by_month(get_nlcd_files())
+    months = sorted(set().union(*prism_files.values()))
+    if not months:
+        raise FileNotFoundError(f"No PRISM files found in {PRISM_DIR}")
     
-    # 4. Load NLCD
-    nlcd_df = load_and_process_nlcd()
-
-    # Merge NLCD
-    # NLCD is annual, merge on lat, lon, year
-    combined = pd.merge(combined, nlcd_df, on=['lat', 'lon', 'year'], how='left')
-    del nlcd_df
-    
-    # 5. Load DEM
-    dem_df = load_and_process_dem()
-
-    # Merge DEM
-    # DEM is static, merge on lat, lon
-    combined = pd.merge(combined, dem_df, on=['lat', 'lon'], how='left')
-    del dem_df
+    writer = None
+    nlcd_year = None
+    prism_nans_warned = False
+    try:
+        for year, month in tqdm(months, desc="Combining months"):
+            # 1. Load PRISM (Base)
+            prism_df = load_and_process_prism({var: files.get((year, month), []) for var, files in prism_files.items()})
+            # Every month is checked; only the first month reports progress
+            verbose = writer is None
+            prism_nans_warned |= verify_prism(prism_df, verbose=verbose, warn_nans=not prism_nans_warned)
+            
+            if verbose:
+                # The summary and static inputs come from the first month
+                print("PRISM Data:")
+                print(prism_df.describe())
+                
+                # Quantize coordinates to PRISM grid indices (all sources share the grid)
+                lat_values = np.unique(prism_df['lat'].to_numpy())
+                lon_values = np.unique(prism_df['lon'].to_numpy())
+                
+                # DEM is static, load once
+                dem_df = load_and_process_dem()
+                dem_df = grid_indexed(dem_df, lat_values, lon_values, [])
+            
+            combined = grid_indexed(prism_df, lat_values, lon_values, ['year', 'month'])
+            del prism_df
+            
+            # 2. Join MTBS
+            mtbs_df = load_and_process_mtbs(mtbs_files.get((year, month), []))
+            verify_mtbs(mtbs_df, verbose=verbose)
+            combined = combined.join(grid_indexed(mtbs_df, lat_values, lon_values, ['year', 'month']), how='left')
+            del mtbs_df
+            
+            # 3. Join NDVI
+            ndvi_df = load_and_process_ndvi(ndvi_files.get((year, month), []))
+            verify_ndvi(ndvi_df, verbose=verbose)
+            combined = combined.join(grid_indexed(ndvi_df, lat_values, lon_values, ['year', 'month']), how='left')
+            del ndvi_df
+            
+            # 4. Join NLCD
+            # NLCD is annual, join on iy, ix, year (loaded once per year)
+            if year != nlcd_year:
+                nlcd_df = load_and_process_nlcd(nlcd_files.get((year,), []))
+                verify_nlcd(nlcd_df, verbose=verbose)
+                nlcd_df = grid_indexed(nlcd_df, lat_values, lon_values, ['year'])
+                nlcd_year = year
+            combined = combined.join(nlcd_df, how='left')
+            
+            # 5. Join DEM
+            # DEM is static, join on iy, ix
+            combined = combined.join(dem_df, how='left')
+            
+            # Restore lat/lon from grid indices
+            combined = combined.reset_index()
+            combined['lat'] = lat_values[combined['iy'].to_numpy()]
+            combined['lon'] = lon_values[combined['ix'].to_numpy()]
+            combined = combined[OUTPUT_COLUMNS]
+            
+            # Fixed dtypes so every month matches the schema of the first
+            combined = combined.astype(OUTPUT_DTYPES)
+            
+            # Append this month as its own row group
+            if writer is None:
+                table = pa.Table.from_pandas(combined, preserve_index=False)
+                print(f"Saving to {OUTPUT_FILE}...")
+                writer = pq.ParquetWriter(OUTPUT_FILE, table.schema, compression='zstd')
+            else:
+                table = pa.Table.from_pandas(combined, schema=writer.schema, preserve_index=False)
+            writer.write_table(table)
+            del combined, table
+    finally:
+        if writer is not None:
+            writer.close()
     
     # Verify
-    verify_final_output(combined)
-    
-    # Save
-    print(f"Saving to {OUTPUT_FILE}...")
-    combined.to_parquet(OUTPUT_FILE)
+    verify_final_output(pq.ParquetFile(OUTPUT_FILE))
     print("Done!")
 
 if __name__ == "__main__":
@@ -1,15 +1,18 @@
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import Optional
-import urllib.request
+import requests
+from requests.adapters import HTTPAdapter
 import zipfile
 from tqdm import tqdm
 import geopandas as gpd
 import rioxarray as rxr
 import xarray as xr
 import numpy as np
-from scipy import stats
+from numba import njit
+from pyproj import Transformer
 import shutil
+import threading
 
 BASE_URL = "https://www.mrlc.gov/downloads/sciweb1/shared/mrlc/data-bundles"
 START_YEAR = 2000
@@ -21,12 +24,19 @@ PRISM_PATH = DATA_DIR / "prism_climate" / "ppt" / "sd_prism_ppt_us_30s_200201.nc
 
 # Excluded NLCD classes
 EXCLUDED_CLASSES = [11, 12, 250]  # Open Water, Perennial Snow, No Data
+# NLCD classes that vote in the per-cell mode (ascending, so ties go to the smallest)
+VOTING_CLASSES = [c for c in [11, 12, 21, 22, 23, 24, 31, 41, 42, 43, 51, 52, 71, 72, 73, 74, 81, 82, 90, 95] if c not in EXCLUDED_CLASSES]
+UPSCALE_BLOCK_ROWS = 2048
+# Threads extracting/binning downloaded years, and downloaded zips allowed to wait for them
+COMPUTE_WORKERS = 2
+MAX_PENDING_ZIPS = 2
+# NLCD pixel -> PRISM cell plans per (NLCD window, PRISM grid)
+_UPSCALE_PLANS = {}
+UPSCALE_PLANS_LOCK = threading.Lock()
 
-class DownloadProgressBar(tqdm):
-    def update_to(self, b=1, bsize=1, tsize=None):
-        if tsize is not None:
-            self.total = tsize
-        self.update(b * bsize - self.n)
+# One pooled keep-alive session for all years
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=5, pool_maxsize=5))
 
 def download_zip_for_year(year: int, output_dir: Path) -> Path:
     filename = f"Annual_NLCD_LndCov_{year}_CU_C1V1.zip"
@@ -35,8 +45,13 @@ def download_zip_for_year(year: int, output_dir: Path) -> Path:
     output_dir.mkdir(parents=True, exist_ok=True)
     zip_path = output_dir / filename
 
-    with DownloadProgressBar(unit='B', unit_scale=True, miniters=1, desc="Downloading " + filename.split('/')[-1]) as dpb:
-        urllib.request.urlretrieve(url, zip_path, reporthook=dpb.update_to)
+    with SESSION.get(url, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        total = int(response.headers.get('content-length', 0)) or None
+        with tqdm(total=total, unit='B', unit_scale=True, miniters=1, desc="Downloading " + filename.split('/')[-1]) as pbar, open(zip_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=1 << 20):
+                f.write(chunk)
+                pbar.update(len(chunk))
     return zip_path
 
 def extract_zip(zip_path: Path, destination: Path) -> None:
@@ -44,8 +59,9 @@ def extract_zip(zip_path: Path, destination: Path) -> None:
         zip_ref.extractall(destination)
     zip_path.unlink()
 
-def clip_to_sd_county(nlcd_path: Path, sd_county: gpd.GeoDataFrame) -> Path:
-    nlcd = rxr.open_rasterio(nlcd_path, masked=True)
+def clip_to_sd_county(nlcd_path: Path, sd_county: gpd.GeoDataFrame) -> xr.DataArray:
+    # Keep native CRS and uint8 classes (nodata is class 250); clip_box reads only the window
+    nlcd = rxr.open_rasterio(nlcd_path)
     sd_county_nlcd_crs = sd_county.to_crs(nlcd.rio.crs)
     nlcd_clipped = nlcd.rio.clip_box(
         minx=sd_county_nlcd_crs.total_bounds[0] - 10000,
@@ -53,65 +69,76 @@ def clip_to_sd_county(nlcd_path: Path, sd_county: gpd.GeoDataFrame) -> Path:
         maxx=sd_county_nlcd_crs.total_bounds[2] + 10000,
         maxy=sd_county_nlcd_crs.total_bounds[3] + 10000
     )
-    nlcd_geo = nlcd_clipped.rio.reproject("EPSG:4326")
-    return nlcd_geo
-
-def mode_statistic(values):
-    """Calculate mode (most common value) for binned_statistic_2d."""
-    if len(values) == 0:
-        return np.nan
-    # Filter out excluded classes before calculating mode
-    filtered = values[~np.isin(values, EXCLUDED_CLASSES)]
-    if len(filtered) == 0:
-        return np.nan
-    mode_result = stats.mode(filtered, keepdims=False)
-    return mode_result.mode
-
-def upscale_to_prism(nlcd_geo, prism, output_path):
-    # Extract NLCD coordinates (fine grid)
-    lon_nlcd = nlcd_geo.coords['x'].values
-    lat_nlcd = nlcd_geo.coords['y'].values
-
-    # Extract PRISM coordinates (coarse grid)
-    lon_prism = prism.coords['x'].values
-    lat_prism = prism.coords['y'].values
+    return nlcd_clipped
+
+def upscale_plan(nlcd, prism):
+    """
+    Flat PRISM cell index (row * width + col) of every NLCD pixel center, -1 off the grid.
+    Depends only on the two grids, so it is computed once and reused for every year.
+    """
+    transform = prism.rio.transform()
+    height, width = prism.rio.height, prism.rio.width
+    key = (nlcd.rio.crs.to_wkt(), nlcd.rio.transform(), nlcd.rio.shape, prism.rio.crs.to_wkt(), transform, (height, width))
+    with UPSCALE_PLANS_LOCK:
+        if key not in _UPSCALE_PLANS:
+            to_prism = Transformer.from_crs(nlcd.rio.crs, prism.rio.crs, always_xy=True)
+            x_nlcd = nlcd.coords['x'].values
+            y_nlcd = nlcd.coords['y'].values
+            
+            # Project pixel centers in row blocks to bound memory
+            cells = np.empty((len(y_nlcd), len(x_nlcd)), dtype=np.int32)
+            for start in range(0, len(y_nlcd), UPSCALE_BLOCK_ROWS):
+                lon, lat = to_prism.transform(*np.meshgrid(x_nlcd, y_nlcd[start:start + UPSCALE_BLOCK_ROWS]))
+                rows = np.floor((lat - transform.f) / transform.e)
+                cols = np.floor((lon - transform.c) / transform.a)
+                on_grid = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+                cells[start:start + UPSCALE_BLOCK_ROWS] = np.where(on_grid, rows * width + cols, -1)
+            _UPSCALE_PLANS[key] = cells
+        return _UPSCALE_PLANS[key]
+
+@njit(nogil=True, cache=True)
+def _count_votes(block, cells, class_id, counts):
+    """Add each voting pixel of a block to counts[cell, class] in one pass."""
+    for j in range(block.shape[0]):
+        for i in range(block.shape[1]):
+            c = class_id[block[j, i]]
+            cell = cells[j, i]
+            if c >= 0 and cell >= 0:
+                counts[cell, c] += 1
+
+def upscale_to_prism(nlcd, prism, output_path):
+    """
+    Most common NLCD class per PRISM cell, binning NLCD pixels in their native CRS.
+    Pixel centers are projected to the PRISM CRS and mapped to cells with the
+    PRISM transform. NaN where no pixel of a VOTING_CLASSES class falls in.
+    """
+    height, width = prism.rio.height, prism.rio.width
+    cells = upscale_plan(nlcd, prism)
     
-    # Create 2D meshgrid and flatten
-    lon_nlcd_2d, lat_nlcd_2d = np.meshgrid(lon_nlcd, lat_nlcd)
-    lon_nlcd_flat = lon_nlcd_2d.flatten()
-    lat_nlcd_flat = lat_nlcd_2d.flatten()
+    # Dense class ids; excluded classes and anything else get -1 and don't vote
+    n_classes = len(VOTING_CLASSES)
+    class_id = np.full(256, -1, dtype=np.int64)
+    class_id[VOTING_CLASSES] = np.arange(n_classes)
     
-    # Flatten NLCD data
-    nlcd_data = np.squeeze(nlcd_geo.data)
-    nlcd_flat = nlcd_data.flatten()
+    # Count class votes per PRISM cell in row blocks to bound memory
+    counts = np.zeros((height * width, n_classes), dtype=np.uint32)
+    for start in range(0, cells.shape[0], UPSCALE_BLOCK_ROWS):
+        block = np.squeeze(nlcd.isel(y=slice(start, start + UPSCALE_BLOCK_ROWS)).values, axis=0)
+        block = np.clip(block, 0, 255).astype(np.uint8)
+        _count_votes(block, cells[start:start + UPSCALE_BLOCK_ROWS], class_id, counts)
+    counts = counts.reshape(height, width, n_classes)
     
-    # Remove NaN values to speed up processing
-    valid_mask = ~np.isnan(nlcd_flat)
-    lon_nlcd_flat = lon_nlcd_flat[valid_mask]
-    lat_nlcd_flat = lat_nlcd_flat[valid_mask]
-    nlcd_flat = nlcd_flat[valid_mask]
-
-    # Create bin edges using np.arange
-    lon_step = abs(lon_prism[1] - lon_prism[0])
-    lat_step = abs(lat_prism[1] - lat_prism[0])
-    lon_bins = np.arange(lon_prism.min(), lon_prism.max() + lon_step, lon_step)
-    lat_bins = np.arange(lat_prism.min(), lat_prism.max() + lat_step, lat_step)
-
-    # Use binned_statistic_2d to aggregate
-    nlcd_coarse = stats.binned_statistic_2d(
-        lon_nlcd_flat,
-        lat_nlcd_flat,
-        nlcd_flat,
-        statistic=mode_statistic,
-        bins=[lon_bins, lat_bins]
-    ).statistic.T
+    # Majority class per cell, NaN where nothing voted
+    nlcd_coarse = np.full((height, width), np.nan)
+    has_votes = counts.any(axis=2)
+    nlcd_coarse[has_votes] = np.array(VOTING_CLASSES, dtype=np.float64)[counts.argmax(axis=2)[has_votes]]
 
     nlcd_output = xr.DataArray(
         nlcd_coarse[np.newaxis, :, :],  # Add band dimension
         coords={
             'band': [1],
-            'y': lat_prism,
-            'x': lon_prism
+            'y': prism.coords['y'].values,
+            'x': prism.coords['x'].values
         },
         dims=['band', 'y', 'x']
     )
@@ -119,21 +146,24 @@ def upscale_to_prism(nlcd_geo, prism, output_path):
     # Set CRS
     nlcd_output = nlcd_output.rio.write_crs(prism.rio.crs)
 
-    nlcd_output.to_netcdf(output_path)
+    # Classes fit in uint8; NaN is stored as 255
+    nlcd_output.to_netcdf(output_path, encoding={'__xarray_dataarray_variable__': {
+        'dtype': 'uint8', '_FillValue': 255, 'zlib': True, 'complevel': 1,
+        'chunksizes': (1, min(128, height), min(128, width))
+    }})
     return nlcd_output
 
-def download_and_extract_year(year: int, output_dir: Path, sd_county: gpd.GeoDataFrame, prism: xr.DataArray) -> xr.DataArray:
-    zip_path = download_zip_for_year(year, output_dir)
+def process_year(year: int, zip_path: Path, sd_county: gpd.GeoDataFrame, prism: xr.DataArray) -> xr.DataArray:
     extract_zip(zip_path, zip_path.parent)
     
     # Clip to SD County
     nlcd_path = zip_path.parent / f"Annual_NLCD_LndCov_{year}_CU_C1V1.tif"
-    nlcd_geo = clip_to_sd_county(nlcd_path, sd_county)
+    nlcd_clipped = clip_to_sd_county(nlcd_path, sd_county)
     
     # Upscale to PRISM grid
     output_filename = f"Annual_NLCD_LndCov_{year}_CU_C1V1_800m.nc"
     output_path = zip_path.parent / output_filename
-    nlcd_output = upscale_to_prism(nlcd_geo, prism, output_path)
+    nlcd_output = upscale_to_prism(nlcd_clipped, prism, output_path)
     
     # Cleanup: remove original TIFF and XML files to save space
     for file in zip_path.parent.glob("*.tif"):
@@ -153,6 +183,9 @@ def verify_nlcd_output(nlcd_outputs: list[xr.DataArray], prism: xr.DataArray, sd
     
     print(f"\nFound {len(nlcd_outputs)} processed NLCD file(s).")
     
+    # Every output is on the PRISM grid, so project the county once
+    sd_bounds = sd_county.to_crs(prism.rio.crs).total_bounds if sd_county is not None else None
+    
     for i, nlcd in enumerate(tqdm(nlcd_outputs, desc="Verifying NLCD outputs"), 1):
         # print(f"\n[{i}/{len(nlcd_outputs)}] Verifying {nlcd.name or 'file ' + str(i)}...")
         
@@ -168,10 +201,8 @@ def verify_nlcd_output(nlcd_outputs: list[xr.DataArray], prism: xr.DataArray, sd
                 all_passed = False
             
             # Check spatial overlap with SD County
-            if sd_county is not None:
-                sd_county_proj = sd_county.to_crs(nlcd.rio.crs)
+            if sd_bounds is not None:
                 nlcd_bounds = nlcd.rio.bounds()
-                sd_bounds = sd_county_proj.total_bounds
                 
                 overlap = not (
                     nlcd_bounds[2] < sd_bounds[0] or
@@ -185,7 +216,9 @@ def verify_nlcd_output(nlcd_outputs: list[xr.DataArray], prism: xr.DataArray, sd
                     all_passed = False
             
             # Check unique classes
-            unique_classes = np.unique(nlcd.values[~np.isnan(nlcd.values)])
+            values = nlcd.values
+            class_counts = np.bincount(values[~np.isnan(values)].astype(np.intp), minlength=256)
+            unique_classes = np.flatnonzero(class_counts)
             print(f"  → {len(unique_classes)} unique landcover classes")
             
         except Exception as e:
@@ -223,19 +256,48 @@ def download_nlcd_annual_data(output_dir: Path = OUTPUT_DIR, max_workers: Option
 
     nlcd_outputs = []
 
-    with ThreadPoolExecutor(max_workers=worker_count) as executor:
-        future_to_year = {
-            executor.submit(download_and_extract_year, year, output_dir, sd_county, prism): year
+    # Downloads run ahead of extract/clip/binning; the semaphore bounds zips on disk
+    pending_zips = threading.BoundedSemaphore(worker_count + MAX_PENDING_ZIPS)
+
+    def download_year(year):
+        pending_zips.acquire()
+        try:
+            return download_zip_for_year(year, output_dir)
+        except BaseException:
+            pending_zips.release()
+            raise
+
+    def compute_year(year, zip_path):
+        try:
+            return process_year(year, zip_path, sd_county, prism)
+        finally:
+            pending_zips.release()
+
+    with ThreadPoolExecutor(max_workers=worker_count) as download_executor, \
+            ThreadPoolExecutor(max_workers=COMPUTE_WORKERS) as compute_executor:
+        download_to_year = {
+            download_executor.submit(download_year, year): year
             for year in years
         }
 
-        for future in as_completed(future_to_year):
-            year = future_to_year[future]
+        # Hand each zip to the compute pool as soon as it lands
+        compute_to_year = {}
+        for future in as_completed(download_to_year):
+            year = download_to_year[future]
+            try:
+                zip_path = future.result()
+            except Exception as exc:
+                print(f"Failed to download {year}: {exc}")
+                continue
+            compute_to_year[compute_executor.submit(compute_year, year, zip_path)] = year
+
+        for future in as_completed(compute_to_year):
+            year = compute_to_year[future]
             try:
                 nlcd_output = future.result()
                 nlcd_outputs.append(nlcd_output)
             except Exception as exc:
-                print(f"Failed to download {year}: {exc}")
+                print(f"Failed to process {year}: {exc}")
 
     verify_nlcd_output(nlcd_outputs, prism, sd_county)
 
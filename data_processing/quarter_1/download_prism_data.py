@@ -1,15 +1,17 @@
 from concurrent.futures import ThreadPoolExecutor, as_completed
+import io
 import os
-import urllib.request
-import urllib.error
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import zipfile
-import time
 from tqdm import tqdm
 import geopandas as gpd
+import rasterio
 import rioxarray
 import xarray as xr
 from shapely.geometry import mapping
-import shutil
+import threading
 
 # Base URL for PRISM data
 BASE_URL = "https://services.nacse.org/prism/data/get/us/800m"
@@ -25,121 +27,118 @@ SD_SHAPEFILE_PATH = os.path.join(DATA_DIR, "sd_county", "sd_county.shp")
 START_YEAR = 2000
 END_YEAR = 2024
 
-def download_and_process_prism_data(start_year, end_year, sd_county, worker_id=0):
+# Concurrent downloads from the public PRISM service
+MAX_WORKERS = 5
+
+# One pooled keep-alive session shared by all download threads.
+# Back off exponentially (honouring Retry-After) when the server answers 429/5xx.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=MAX_WORKERS,
+    pool_maxsize=MAX_WORKERS,
+    max_retries=Retry(total=6, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504),
+                      respect_retry_after_header=True)
+))
+
+# SD county geometries per raster CRS, shared by all download threads
+_SD_GEOMS = {}
+SD_GEOMS_LOCK = threading.Lock()
+
+def sd_geometries(sd_county, crs):
+    """
+    Return the SD county dissolved to one GeoJSON-like mapping in the given CRS,
+    plus its total bounds. Reprojection runs once per CRS; every PRISM file shares one.
     """
-    Downloads PRISM climate data for years 1999-2024 and months 1-12.
+    key = crs.to_wkt()
+    with SD_GEOMS_LOCK:
+        if key not in _SD_GEOMS:
+            sd_county_proj = sd_county.to_crs(crs) if sd_county.crs != crs else sd_county
+            _SD_GEOMS[key] = ([mapping(sd_county_proj.union_all())], sd_county_proj.total_bounds)
+        return _SD_GEOMS[key]
+
+def download_and_process_prism_file(year, month, dtype, sd_county):
+    """
+    Downloads one month of one PRISM variable.
     Subsets the data to San Diego County immediately after download.
     """
-    # Calculate total downloads
-    total_years = end_year - start_year + 1
-    total_months = 12
-    total_downloads = total_years * total_months * len(DATA_TYPES)
-
-    # Loop through years and months with progress bar
-    desc = f"Worker {worker_id} ({start_year}-{end_year})"
-    with tqdm(total=total_downloads, desc=desc, position=worker_id) as pbar:
-        for year in range(start_year, end_year + 1):
-            for month in range(1, 13):
-                # Format date string as YYYYMM
-                date_str = f"{year}{month:02d}"
-                
-                for dtype in DATA_TYPES:
-                    # Construct URL
-                    url = f"{BASE_URL}/{dtype}/{date_str}?format=nc"
-                    
-                    # Construct filename
-                    filename = f"prism_{dtype}_us_30s_{date_str}.zip"
-                    filepath = os.path.join(OUTPUT_DIR, filename)
-                    
-                    # Target subset file path
-                    output_filename = f"sd_prism_{dtype}_us_30s_{date_str}.nc"
-                    output_path = os.path.join(OUTPUT_DIR, dtype, output_filename)
-
-                    try:
-                        # Check if subset file already exists to skip download
-                        if os.path.exists(output_path):
-                             pbar.update(1)
-                             continue
-
-                        # Download the file
-                        urllib.request.urlretrieve(url, filepath)
-                        
-                        # Extract
-                        extract_path = os.path.join(OUTPUT_DIR, f"{dtype}", date_str)
-                        if not os.path.exists(extract_path):
-                            os.makedirs(extract_path)
-                        
-                        try:
-                            with zipfile.ZipFile(filepath, 'r') as z:
-                                z.extractall(extract_path)
-                        except zipfile.BadZipFile:
-                            print(f"  Error: Downloaded content for {dtype} {date_str} is not a valid zip file.")
-                            if os.path.exists(filepath):
-                                with open(filepath, 'rb') as f:
-                                    print(f"  Content preview: {f.read(200)}")
-                                os.remove(filepath)
-                            pbar.update(1)
-                            continue
-                        
-                        # Remove the zip file
-                        if os.path.exists(filepath):
-                            os.remove(filepath)
-                        
-                        # Process (Subset) immediately
-                        # Find the .nc file
-                        nc_file = None
-                        for f in os.listdir(extract_path):
-                            if f.endswith(".nc"):
-                                nc_file = os.path.join(extract_path, f)
-                                break
-                        
-                        if nc_file:
-                            rds = None
-                            try:
-                                # Open raster
-                                rds = rioxarray.open_rasterio(nc_file)
-                                
-                                if rds.rio.crs != sd_county.crs:
-                                    # It's better to project the vector to the raster CRS to avoid warping the raster grid
-                                    sd_county_proj = sd_county.to_crs(rds.rio.crs)
-                                else:
-                                    sd_county_proj = sd_county
-
-                                # Clip
-                                clipped = rds.rio.clip(sd_county_proj.geometry.apply(mapping), sd_county_proj.crs)
-                                
-                                # Save subset
-                                clipped.to_netcdf(output_path)
-                                
-                            except Exception as e:
-                                print(f"  Error processing {nc_file}: {e}")
-                            finally:
-                                if rds is not None:
-                                    rds.close()
-                        
-                        # Cleanup extracted folder to save space
-                        for attempt in range(5):
-                            try:
-                                if os.path.exists(extract_path):
-                                    shutil.rmtree(extract_path)
-                                break
-                            except OSError as e:
-                                if attempt == 4:
-                                    print(f"  Warning: Failed to remove {extract_path} after retries: {e}")
-                                else:
-                                    time.sleep(0.5)
-                        
-                        # Add a small delay
-                        time.sleep(0.1)
-                        
-                    except urllib.error.URLError as e:
-                        print(f"  Error downloading {url}: {e}")
-                    except Exception as e:
-                        print(f"  An unexpected error occurred: {e}")
-                        if os.path.exists(filepath):
-                            os.remove(filepath)
-                    
-                    pbar.update(1)
+    # Format date string as YYYYMM
+    date_str = f"{year}{month:02d}"
+
+    # Construct URL
+    url = f"{BASE_URL}/{dtype}/{date_str}?format=nc"
+    
+    # Target subset file path
+    output_filename = f"sd_prism_{dtype}_us_30s_{date_str}.nc"
+    output_path = os.path.join(OUTPUT_DIR, dtype, output_filename)
+
+    # Raw CONUS NetCDF, kept on disk only while it is being clipped
+    nc_file = os.path.join(OUTPUT_DIR, dtype, f"prism_{dtype}_us_30s_{date_str}.nc")
+
+    try:
+        # Check if subset file already exists to skip download
+        if os.path.exists(output_path):
+            return
+
+        # Download the zip into memory (a few MB)
+        response = SESSION.get(url, timeout=60)
+        response.raise_for_status()
+
+        # Pull the .nc member straight out of the in-memory zip
+        try:
+            with zipfile.ZipFile(io.BytesIO(response.content)) as z:
+                nc_name = next((name for name in z.namelist() if name.endswith(".nc")), None)
+                if nc_name is None:
+                    return
+                with open(nc_file, 'wb') as f:
+                    f.write(z.read(nc_name))
+        except zipfile.BadZipFile:
+            print(f"  Error: Downloaded content for {dtype} {date_str} is not a valid zip file.")
+            print(f"  Content preview: {response.content[:200]}")
+            return
+
+        # Process (Subset) immediately
+        rds = None
+        try:
+            # Open raster
+            rds = rioxarray.open_rasterio(nc_file)
+
+            # It's better to project the vector to the raster CRS to avoid warping the raster grid
+            sd_geoms, sd_bounds = sd_geometries(sd_county, rds.rio.crs)
+
+            # Clip; the lazy bounding-box window is all that gets read from disk
+            clipped = rds.rio.clip_box(*sd_bounds).rio.clip(sd_geoms, rds.rio.crs)
+
+            # Save subset as float32 (PRISM's native precision), chunked and lightly compressed
+            clipped.encoding.update({
+                'dtype': 'float32', 'zlib': True, 'complevel': 1, 'shuffle': True,
+                'chunksizes': (1, min(64, clipped.rio.height), min(64, clipped.rio.width))
+            })
+            clipped.to_netcdf(output_path)
+
+        except Exception as e:
+            print(f"  Error processing {nc_file}: {e}")
+        finally:
+            if rds is not None:
+                rds.close()
+            # Remove the raw CONUS file (the raster is closed by now) to save space
+            os.remove(nc_file)
+
+    except requests.RequestException as e:
+        print(f"  Error downloading {url}: {e}")
+    except Exception as e:
+        print(f"  An unexpected error occurred: {e}")
+        if os.path.exists(nc_file):
+            os.remove(nc_file)
+
+def subset_overlaps_sd(file_path, sd_county):
+    """
+    Check a subset's bounds against San Diego County from the file header alone.
+    """
+    with rasterio.open(file_path) as src:
+        # Project SD to raster CRS for the check (cached per CRS)
+        _, sd_bounds = sd_geometries(sd_county, src.crs)
+        r_bounds = src.bounds
+    return not (r_bounds[2] < sd_bounds[0] or r_bounds[0] > sd_bounds[2] or r_bounds[3] < sd_bounds[1] or r_bounds[1] > sd_bounds[3])
 
 def verify_prism_output():
     found_files = []
@@ -166,7 +165,7 @@ def verify_prism_output():
     # Load SD shapefile once for comparison
     sd_shapefile_path = os.path.join("data", "sd_county", "sd_county.shp")
     try:
-        sd_county = gpd.read_file(sd_shapefile_path)
+        sd_county = gpd.read_file(sd_shapefile_path, use_arrow=True)
     except Exception as e:
         print(f"FAILED: Could not load SD shapefile: {e}")
         return
@@ -175,44 +174,27 @@ def verify_prism_output():
     failed_count = 0
     
     print("Verifying all files...")
-    for file_path in tqdm(found_files):
-        try:
-            rds = rioxarray.open_rasterio(file_path)
-            
-            # Ensure CRS matches (or project SD to raster CRS)
-            # We'll project SD to raster CRS for the check
-            if rds.rio.crs != sd_county.crs:
-                 sd_county_proj = sd_county.to_crs(rds.rio.crs)
-            else:
-                 sd_county_proj = sd_county
-            
-            sd_bounds = sd_county_proj.total_bounds
-            r_bounds = rds.rio.bounds()
-            
-            # Check overlap
-            overlap = not (r_bounds[2] < sd_bounds[0] or r_bounds[0] > sd_bounds[2] or r_bounds[3] < sd_bounds[1] or r_bounds[1] > sd_bounds[3])
-            
-            if overlap:
-                passed_count += 1
-            else:
-                print(f"FAILED: {os.path.basename(file_path)} does not overlap with San Diego County.")
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        future_to_path = {executor.submit(subset_overlaps_sd, file_path, sd_county): file_path for file_path in found_files}
+        for future in tqdm(as_completed(future_to_path), total=len(future_to_path)):
+            file_path = future_to_path[future]
+            try:
+                if future.result():
+                    passed_count += 1
+                else:
+                    print(f"FAILED: {os.path.basename(file_path)} does not overlap with San Diego County.")
+                    failed_count += 1
+            except Exception as e:
+                print(f"FAILED: Error checking {os.path.basename(file_path)}: {e}")
                 failed_count += 1
-                
-            rds.close()
-
-        except Exception as e:
-            print(f"FAILED: Error checking {os.path.basename(file_path)}: {e}")
-            failed_count += 1
 
     print(f"\nVerification Complete.")
     print(f"Passed: {passed_count}")
     print(f"Failed: {failed_count}")
 
 def main():
-    # Determine number of workers
-    total_years = END_YEAR - START_YEAR + 1
-    max_workers = 5 # Set a reasonable maximum
-    num_workers = min(max_workers, total_years)
+    # Determine number of workers (concurrent downloads)
+    num_workers = MAX_WORKERS
     
     print(f"Starting download and processing with {num_workers} workers...")
 
@@ -231,32 +213,28 @@ def main():
         return
     
     print("Loading San Diego shapefile...")
-    sd_county = gpd.read_file(SD_SHAPEFILE_PATH)
-
-    # Calculate years per worker
-    years_per_worker = total_years // num_workers
-    remainder = total_years % num_workers
+    sd_county = gpd.read_file(SD_SHAPEFILE_PATH, use_arrow=True)
 
-    futures = []
-    current_start_year = START_YEAR
+    # Queue every (year, month, variable) at once; the pool caps concurrent downloads
+    tasks = [
+        (year, month, dtype)
+        for year in range(START_YEAR, END_YEAR + 1)
+        for month in range(1, 13)
+        for dtype in DATA_TYPES
+    ]
 
     with ThreadPoolExecutor(max_workers=num_workers) as executor:
-        for i in range(num_workers):
-            # Distribute remainder years to the first few workers
-            count = years_per_worker + (1 if i < remainder else 0)
-            current_end_year = current_start_year + count - 1
-            
-            # Submit task - Pass sd_county
-            futures.append(executor.submit(download_and_process_prism_data, current_start_year, current_end_year, sd_county, i))
-            
-            current_start_year = current_end_year + 1
+        futures = [
+            executor.submit(download_and_process_prism_file, year, month, dtype, sd_county)
+            for year, month, dtype in tasks
+        ]
 
         # Wait for all tasks to complete
-        for future in as_completed(futures):
+        for future in tqdm(as_completed(futures), total=len(futures), desc="PRISM files"):
             try:
                 future.result()
             except Exception as e:
-                print(f"Worker failed with error: {e}")
+                print(f"Task failed with error: {e}")
 
     verify_prism_output()
 
@@ -1,9 +1,12 @@
-import urllib.request
+import requests
 import zipfile
 from pathlib import Path
 import geopandas as gpd
 import shutil
 
+# Shapefile components needed to read the county layer
+SHAPEFILE_EXTENSIONS = {".shp", ".shx", ".dbf", ".prj", ".cpg"}
+
 def download_census_county_data(output_dir=None):
     """
     Download and extract US county shapefile data from Census Bureau,
@@ -31,14 +34,20 @@ def download_census_county_data(output_dir=None):
     print(f"Downloading data from {url}")
     
     try:
-        # Download the file
-        urllib.request.urlretrieve(url, zip_filename)
+        # Download the file (streamed in 1 MiB chunks)
+        with requests.get(url, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            with open(zip_filename, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1 << 20):
+                    f.write(chunk)
         print(f"Download complete: {zip_filename}")
         
-        # Extract the zip file
+        # Extract only the shapefile components
         print(f"Extracting files to {output_path}")
         with zipfile.ZipFile(zip_filename, 'r') as zip_ref:
-            zip_ref.extractall(output_path)
+            members = [info for info in zip_ref.infolist() if Path(info.filename).suffix.lower() in SHAPEFILE_EXTENSIONS]
+            for info in members:
+                zip_ref.extract(info, output_path)
         
         print("Extraction complete!")
         
@@ -46,14 +55,10 @@ def download_census_county_data(output_dir=None):
         if zip_filename.exists():
             zip_filename.unlink()
 
-        # Load the US counties shapefile
+        # Load San Diego County only; the filter runs inside OGR
         us_shapefile_path = output_path / "tl_2025_us_county.shp"
-        print(f"Loading shapefile from {us_shapefile_path}")
-        counties = gpd.read_file(us_shapefile_path)
-        
-        # Filter for San Diego County
-        print("Filtering for San Diego County...")
-        sd_county = counties[counties["NAME"] == "San Diego"]
+        print(f"Loading San Diego County from {us_shapefile_path}")
+        sd_county = gpd.read_file(us_shapefile_path, where="NAME = 'San Diego'")
         
         # Save San Diego shapefile
         sd_output_path = output_path / "sd_county.shp"
@@ -62,9 +67,8 @@ def download_census_county_data(output_dir=None):
         
         # Cleanup: Remove original shapefile components
         print(f"Cleaning up original shapefile components in {output_path}")
-        for file in output_path.iterdir():
-            if file.name.startswith("tl_2025_us_county"):
-                file.unlink()
+        for info in members:
+            (output_path / info.filename).unlink(missing_ok=True)
         
         print(f"\nProcess complete. Files saved to: {output_path.absolute()}")
         
@@ -1,16 +1,20 @@
 import os
+import math
 from pathlib import Path
 import rioxarray as rxr
 import xarray as xr
 import numpy as np
-from scipy import stats
-from rioxarray.merge import merge_arrays
+from numba import get_num_threads, njit, prange
+import rasterio
+from rasterio.merge import merge as rio_merge
 
 # Constants
 DATA_DIR = Path(__file__).resolve().parent.parent / "data"
 INPUT_DIR = Path.home() / "teams/b13-domain-2/data/USGS_DEM"
 OUTPUT_DIR = DATA_DIR / "usgs_dem"
 PRISM_REF_PATH = DATA_DIR / "prism_climate" / "ppt" / "sd_prism_ppt_us_30s_200001.nc"
+# Fine-grid rows per slope/binning block (bounds the full-size temporaries)
+DEM_BLOCK_ROWS = 1024
 
 def load_and_merge_dems(input_dir: Path) -> xr.DataArray:
     """Load all TIFF files in input_dir and merge them."""
@@ -19,103 +23,175 @@ def load_and_merge_dems(input_dir: Path) -> xr.DataArray:
         raise FileNotFoundError(f"No TIFF files found in {input_dir}")
     
     print(f"Found {len(dem_files)} DEM files. Loading and merging...")
-    dems = [rxr.open_rasterio(p, masked=True).squeeze() for p in dem_files]
-    merged = merge_arrays(dems)
+    with rasterio.open(dem_files[0]) as src:
+        crs, nodata = src.crs, src.nodata
+    
+    # rasterio reads and blits one tile at a time into the mosaic, so only the mosaic is held in memory
+    mosaic, transform = rio_merge(dem_files)
+    height, width = mosaic.shape[-2:]
+    merged = xr.DataArray(
+        mosaic[0],
+        coords={
+            'y': transform.f + (np.arange(height) + 0.5) * transform.e,
+            'x': transform.c + (np.arange(width) + 0.5) * transform.a,
+        },
+        dims=('y', 'x'),
+    )
+    merged.rio.write_crs(crs, inplace=True)
+    merged.rio.write_transform(transform, inplace=True)
+    merged.rio.write_nodata(nodata, inplace=True)
     print(f"Merged DEM shape: {merged.shape}")
     return merged
 
-def get_fine_grid_coords(dem: xr.DataArray):
-    """Generate flattened coordinate arrays for the fine grid."""
-    X_fine = dem.coords['x'].values
-    Y_fine = dem.coords['y'].values
-    Xf, Yf = np.meshgrid(X_fine, Y_fine)
-    return Xf.flatten(), Yf.flatten()
-
-def calculate_fine_slope_aspect(dem: xr.DataArray):
-    """Calculate elevation, slope, and aspect components on the fine grid."""
-    print("Calculating slope and aspect on fine grid...")
-    elevf = dem.values
-    nodata = dem.rio.nodata
-    if nodata is not None:
-        elevf = np.where(elevf == nodata, np.nan, elevf)
+@njit(parallel=True, cache=True)
+def _slope_kernel(elev, y_coords, res_x, res_y, is_geographic, sx, sy, slope):
+    """Fused gradient/scaling/slope pass (matches np.gradient: central inside, one-sided at edges)."""
+    ny, nx = elev.shape
+    for j in prange(ny):
+        # Per-row metres per unit (degrees if geographic)
+        scale_x = res_x
+        scale_y = res_y
+        if is_geographic:
+            scale_x = res_x * 111132 * np.cos(np.radians(y_coords[j]))
+            scale_y = res_y * 111132
+        
+        j0 = max(j - 1, 0)
+        j1 = min(j + 1, ny - 1)
+        for i in range(nx):
+            i0 = max(i - 1, 0)
+            i1 = min(i + 1, nx - 1)
+            gx = (elev[j, i1] - elev[j, i0]) / (i1 - i0)
+            gy = (elev[j1, i] - elev[j0, i]) / (j1 - j0)
+            sx_m = gx / scale_x
+            sy_m = gy / scale_y
+            sx[j, i] = sx_m
+            sy[j, i] = sy_m
+            # Slope gradients are nowhere near overflow, so skip hypot's rescaling
+            slope[j, i] = math.sqrt(sx_m * sx_m + sy_m * sy_m)
 
-    # Calculate gradients (dy is axis 0, dx is axis 1)
-    grad_y, grad_x = np.gradient(elevf)
+def calculate_fine_slope_aspect(elevf, y_coords, res_x, res_y, is_geographic):
+    """Calculate slope and slope components for a block of fine-grid rows."""
+    # One pass over the block instead of a chain of full-size NumPy temporaries.
+    # float32 outputs halve the memory traffic of the binning pass (kernel math is float64)
+    slope_x_m = np.empty(elevf.shape, dtype=np.float32)
+    slope_y_m = np.empty(elevf.shape, dtype=np.float32)
+    slopef = np.empty(elevf.shape, dtype=np.float32)
+    _slope_kernel(elevf, y_coords.astype(np.float64), res_x, res_y, is_geographic, slope_x_m, slope_y_m, slopef)
     
-    # Handle units (degrees vs meters)
-    if dem.rio.crs.to_epsg() == 4269 or dem.rio.crs.is_geographic:
-        res_x = abs(dem.rio.resolution()[0])
-        res_y = abs(dem.rio.resolution()[1])
-        
-        # Convert gradients to degrees
-        slope_y_deg = grad_y / res_y
-        slope_x_deg = grad_x / res_x
-        
-        # Scale to meters
-        Y_fine = dem.coords['y'].values
-        _, Yf = np.meshgrid(dem.coords['x'].values, Y_fine)
-        
-        lat_rad = np.radians(Yf)
-        scale_x = 111132 * np.cos(lat_rad)
-        scale_y = 111132
-        
-        slope_y_m = slope_y_deg / scale_y
-        slope_x_m = slope_x_deg / scale_x
-    else:
-        # Assume projected meters
-        res_x = abs(dem.rio.resolution()[0])
-        res_y = abs(dem.rio.resolution()[1])
-        slope_y_m = grad_y / res_y
-        slope_x_m = grad_x / res_x
-
-    slopef = np.hypot(slope_x_m, slope_y_m)
+    return slopef, slope_x_m, slope_y_m
+
+def bin_indices(coords, edges):
+    """
+    Bin index of each coordinate along one axis, -1 outside the edges.
+    Same rule as binned_statistic_2d: half-open bins, the last one closed on the right.
+    """
+    idx = np.digitize(coords, edges) - 1
+    decimal = int(-np.log10(np.diff(edges).min())) + 6
+    on_last_edge = (coords >= edges[-1]) & (np.around(coords, decimal) == np.around(edges[-1], decimal))
+    idx[on_last_edge] -= 1
+    idx[(idx < 0) | (idx >= len(edges) - 1)] = -1
+    return idx
+
+@njit(parallel=True, cache=True)
+def _accumulate_kernel(blocks, ix, iy, nx, n_chunks, sums, counts):
+    """
+    Add every valid (on-grid, non-NaN) pixel of each variable's block to its coarse cell's sum and count.
+    Rows are split into n_chunks contiguous runs with private buffers, reduced in chunk order.
+    """
+    nvars = len(blocks)
+    nrows, ncols = blocks[0].shape
+    local_sums = np.zeros((n_chunks, nvars, sums.shape[1]))
+    local_counts = np.zeros((n_chunks, nvars, counts.shape[1]), dtype=np.int64)
+    step = (nrows + n_chunks - 1) // n_chunks
+    for t in prange(n_chunks):
+        for j in range(t * step, min((t + 1) * step, nrows)):
+            r = iy[j]
+            if r < 0:
+                continue
+            for i in range(ncols):
+                c = ix[i]
+                if c < 0:
+                    continue
+                cell = r * nx + c
+                for k in range(nvars):
+                    v = blocks[k][j, i]
+                    if not np.isnan(v):
+                        local_sums[t, k, cell] += v
+                        local_counts[t, k, cell] += 1
     
-    return elevf, slopef, slope_x_m, slope_y_m
-
-def upscale_variable(lonf, latf, data, lon_edges, lat_edges, statistic='mean'):
-    """Upscale a single variable using binned_statistic_2d."""
-    mask = ~np.isnan(data)
-    ret = stats.binned_statistic_2d(
-        lonf[mask], 
-        latf[mask], 
-        data[mask], 
-        statistic=statistic, 
-        bins=[lon_edges, lat_edges]
-    )
-    return ret.statistic.T
+    for t in range(n_chunks):
+        sums += local_sums[t]
+        counts += local_counts[t]
+
+def accumulate_block(blocks, ix, iy, nx, sums, counts):
+    """Add the valid fine cells of each variable's block to its per-coarse-cell sums and counts (summed in float64)."""
+    _accumulate_kernel(blocks, ix, iy, nx, get_num_threads(), sums, counts)
 
-def process_upscaling(elevf, slopef, slope_x, slope_y, lonf, latf, prism):
-    """Upscale all variables to the PRISM grid."""
-    print("Upscaling to PRISM grid...")
+def upscale_variable(sums, counts, nx, ny):
+    """Upscale a single variable: mean of the valid fine cells in each coarse cell, shaped (y, x)."""
+    mean = np.full(nx * ny, np.nan)
+    filled = counts > 0
+    mean[filled] = sums[filled] / counts[filled]
+    return mean.reshape(ny, nx)
+
+def process_upscaling(dem: xr.DataArray, prism: xr.DataArray):
+    """
+    Calculate slope on the fine grid and upscale all variables to the PRISM grid.
+    The DEM is streamed in blocks of DEM_BLOCK_ROWS rows straight into the coarse sums.
+    """
+    print("Calculating slope and aspect on fine grid and upscaling to PRISM grid...")
     lonc = prism.coords['x'].values
     latc = prism.coords['y'].values
     
-    # Calculate bin edges
+    # Calculate bin edges (increasing whatever the coordinate order; PRISM y runs north to south)
     dx = np.abs(lonc[1] - lonc[0])
     dy = np.abs(latc[1] - latc[0])
+    lon_edges = np.linspace(lonc.min() - dx/2, lonc.max() + dx/2, lonc.size + 1)
+    lat_edges = np.linspace(latc.min() - dy/2, latc.max() + dy/2, latc.size + 1)
+
+    # Elevation with nodata as NaN, masked in place (the merged DEM is not used afterwards)
+    elevf = dem.values.astype(np.float32, copy=False)
+    nodata = dem.rio.nodata
+    if nodata is not None:
+        if not elevf.flags.writeable:
+            elevf = elevf.copy()
+        np.putmask(elevf, elevf == nodata, np.nan)
     
-    if lonc[1] > lonc[0]:
-        lon_edges = np.append(lonc - dx/2, lonc[-1] + dx/2)
-    else:
-        lon_edges = np.append(lonc + dx/2, lonc[-1] - dx/2)
+    height = elevf.shape[0]
+    if min(elevf.shape) < 2:
+        raise ValueError("DEM too small to compute a gradient")
+
+    # Gradients are converted to meters if CRS is Geographic, else assumed projected meters
+    is_geographic = bool(dem.rio.crs.to_epsg() == 4269 or dem.rio.crs.is_geographic)
+    res_x = abs(dem.rio.resolution()[0])
+    res_y = abs(dem.rio.resolution()[1])
+
+    # Coarse column/row of every fine column/row, computed once and shared by all four variables.
+    # The fine grid is regular, so the 1-D coords are enough (no meshgrid)
+    nx, ny = len(lon_edges) - 1, len(lat_edges) - 1
+    y_fine = dem.coords['y'].values
+    ix = bin_indices(dem.coords['x'].values, lon_edges)
+    iy = bin_indices(y_fine, lat_edges)
+
+    # Running sums/counts per variable (elevation, slope, slope_x, slope_y) on the coarse grid
+    sums = np.zeros((4, nx * ny))
+    counts = np.zeros((4, nx * ny), dtype=np.int64)
+
+    for r0 in range(0, height, DEM_BLOCK_ROWS):
+        r1 = min(r0 + DEM_BLOCK_ROWS, height)
         
-    if latc[1] > latc[0]:
-        lat_edges = np.append(latc - dy/2, latc[-1] + dy/2)
-    else:
-        lat_edges = np.append(latc + dy/2, latc[-1] - dy/2)
-    
-    # Ensure increasing
-    if lon_edges[0] > lon_edges[-1]: lon_edges = lon_edges[::-1]
-    if lat_edges[0] > lat_edges[-1]: lat_edges = lat_edges[::-1]
+        # One halo row on each side keeps the block's central differences identical to a full-grid pass
+        h0, h1 = max(r0 - 1, 0), min(r1 + 1, height)
+        slopef, slope_x, slope_y = calculate_fine_slope_aspect(elevf[h0:h1], y_fine[h0:h1], res_x, res_y, is_geographic)
+        core = slice(r0 - h0, r1 - h0)
+        
+        # All four variables in one multi-core pass over the block
+        accumulate_block((elevf[r0:r1], slopef[core], slope_x[core], slope_y[core]), ix, iy[r0:r1], nx, sums, counts)
 
     # Upscale
-    elevc = upscale_variable(lonf, latf, elevf.flatten(), lon_edges, lat_edges)
-    slopec = upscale_variable(lonf, latf, slopef.flatten(), lon_edges, lat_edges)
-    slopec_x = upscale_variable(lonf, latf, slope_x.flatten(), lon_edges, lat_edges)
-    slopec_y = upscale_variable(lonf, latf, slope_y.flatten(), lon_edges, lat_edges)
+    elevc, slopec, slopec_x, slopec_y = (upscale_variable(sums[k], counts[k], nx, ny) for k in range(4))
     
-    # Recalculate aspect from upscaled components
-    slopec_x = np.where(np.isclose(slopec_x, 0, atol=1e-12), 1e-3, slopec_x)
+    # Recalculate aspect from upscaled components (arctan2 is defined for slopec_x == 0)
     aspectc = np.arctan2(slopec_y, slopec_x)
     
     return elevc, slopec, aspectc
@@ -139,37 +215,41 @@ def save_output(elevc, slopec, aspectc, prism, output_dir):
     
     ds_out.rio.write_crs(prism.rio.crs, inplace=True)
     out_path = output_dir / "usgs_dem_800m.nc"
+    
+    # Smooth terrain grids compress well; chunk and lightly compress each variable
+    # (updated in place so the grid_mapping set by write_crs is kept)
+    chunks = (min(256, ds_out.sizes['y']), min(256, ds_out.sizes['x']))
+    for var in ("elevation", "slope", "aspect"):
+        ds_out[var].encoding.update({'zlib': True, 'complevel': 1, 'shuffle': True, 'chunksizes': chunks})
     ds_out.to_netcdf(out_path)
     print(f"Saved to {out_path}")
     return out_path
 
-def verify_output(output_path: Path, prism: xr.DataArray):
-    """Verify the output file matches PRISM grid."""
+def verify_output(output_path: Path, prism_meta):
+    """Verify the output file matches PRISM grid, given the PRISM (shape, crs, bounds) read once in main."""
     print("\nVerifying output...")
+    prism_shape, prism_crs, ref_bounds = prism_meta
     try:
-        ds = rxr.open_rasterio(output_path)
-        
-        # Check Shape
-        # ds is a Dataset, prism is a DataArray
-        ds_shape = (ds.rio.height, ds.rio.width)
-        prism_shape = (prism.rio.height, prism.rio.width)
-        
-        if ds_shape != prism_shape:
-             print(f"FAILED: Shape mismatch. Output: {ds_shape}, Reference: {prism_shape}")
-             return
-
-        # Check CRS
-        if ds.rio.crs != prism.rio.crs:
-            print(f"FAILED: CRS mismatch. Output: {ds.rio.crs}, Reference: {prism.rio.crs}")
-            return
-
-        # Check Bounds
-        r_bounds = ds.rio.bounds()
-        ref_bounds = prism.rio.bounds()
-        # Allow small float diff
-        if not np.allclose(r_bounds, ref_bounds, atol=1e-3):
-             print(f"FAILED: Bounds mismatch.\nOutput: {r_bounds}\nReference: {ref_bounds}")
-             return
+        with rxr.open_rasterio(output_path) as ds:
+            # Check Shape
+            # ds is a Dataset, the reference shape is (height, width)
+            ds_shape = (ds.rio.height, ds.rio.width)
+            
+            if ds_shape != prism_shape:
+                 print(f"FAILED: Shape mismatch. Output: {ds_shape}, Reference: {prism_shape}")
+                 return
+
+            # Check CRS
+            if ds.rio.crs != prism_crs:
+                print(f"FAILED: CRS mismatch. Output: {ds.rio.crs}, Reference: {prism_crs}")
+                return
+
+            # Check Bounds
+            r_bounds = ds.rio.bounds()
+            # Allow small float diff
+            if not np.allclose(r_bounds, ref_bounds, atol=1e-3):
+                 print(f"FAILED: Bounds mismatch.\nOutput: {r_bounds}\nReference: {ref_bounds}")
+                 return
              
         print("SUCCESS: Output file passed verification.")
         
@@ -179,28 +259,23 @@ def verify_output(output_path: Path, prism: xr.DataArray):
         traceback.print_exc()
 
 def main():
-    # 1. Load Data
-    dem = load_and_merge_dems(INPUT_DIR)
-    
+    # 1. Load Data (check the small reference before reading the DEM tiles)
     if not PRISM_REF_PATH.exists():
         print(f"PRISM reference file not found: {PRISM_REF_PATH}")
         return
     prism = rxr.open_rasterio(PRISM_REF_PATH)
+    prism_meta = ((prism.rio.height, prism.rio.width), prism.rio.crs, prism.rio.bounds())
     
-    # 2. Prepare Fine Grid
-    lonf, latf = get_fine_grid_coords(dem)
-    
-    # 3. Calculate Fine Scale Variables
-    elevf, slopef, slope_x, slope_y = calculate_fine_slope_aspect(dem)
+    dem = load_and_merge_dems(INPUT_DIR)
     
-    # 4. Upscale
-    elevc, slopec, aspectc = process_upscaling(elevf, slopef, slope_x, slope_y, lonf, latf, prism)
+    # 2. Calculate Fine Scale Variables and Upscale, block by block
+    elevc, slopec, aspectc = process_upscaling(dem, prism)
     
-    # 5. Save
+    # 3. Save
     out_path = save_output(elevc, slopec, aspectc, prism, OUTPUT_DIR)
     
-    # 6. Verify
-    verify_output(out_path, prism)
+    # 4. Verify
+    verify_output(out_path, prism_meta)
 
 if __name__ == "__main__":
     main()
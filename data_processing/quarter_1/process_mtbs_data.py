@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import geopandas as gpd
 import pandas as pd
 from pathlib import Path
@@ -5,6 +6,7 @@ import os
 import rioxarray
 import xarray as xr
 import numpy as np
+import shapely
 import rasterio
 from rasterio import features
 from tqdm import tqdm
@@ -17,6 +19,9 @@ INPUT_MTBS_PATH = Path.home() / "teams/b13-domain-2/data/mtbs_perimeter_data/mtb
 DATA_DIR = Path(__file__).resolve().parent.parent / "data"
 SD_COUNTY_PATH = DATA_DIR / "sd_county" / "sd_county.shp"
 
+# MTBS attributes used by the filters
+MTBS_COLUMNS = ['Ig_Date', 'Incid_Type']
+
 # Output directory for the processed file
 OUTPUT_DIR = DATA_DIR / "mtbs_perimeter"
 OUTPUT_FILE = OUTPUT_DIR / "sd_mtbs_perims.shp"
@@ -32,8 +37,9 @@ def filter_county(input_path: Path, sd_county: gpd.GeoDataFrame) -> gpd.GeoDataF
     """
     Load the MTBS perimeter file and clip it to San Diego County.
     """
-    # Read the MTBS Perimeter shapefile
-    mtbs_data = gpd.read_file(input_path)
+    # Read only the perimeters inside the county bbox, with the columns used downstream
+    # (a GeoDataFrame bbox is reprojected to the file's CRS by the reader)
+    mtbs_data = gpd.read_file(input_path, bbox=sd_county, columns=MTBS_COLUMNS, use_arrow=True)
     print(f"Loaded {len(mtbs_data)} fire perimeters. CRS: {mtbs_data.crs} from {input_path}")
 
     # Reproject if different CRS
@@ -43,9 +49,16 @@ def filter_county(input_path: Path, sd_county: gpd.GeoDataFrame) -> gpd.GeoDataF
     else:
         print("CRS matches. No reprojection needed.")
 
-    # Clip to SD County
+    # Clip to SD County: spatial-index candidates, then intersect only the perimeters crossing the boundary
     print("Clipping MTBS data to San Diego County...")
-    mtbs_clipped = gpd.clip(mtbs_data, sd_county)
+    sd_geom = sd_county.geometry.union_all()
+    shapely.prepare(sd_geom)
+    candidates = mtbs_data.iloc[np.sort(mtbs_data.sindex.query(sd_geom, predicate="intersects"))]
+    geoms = candidates.geometry.to_numpy()
+    crossing = ~shapely.contains_properly(sd_geom, geoms)
+    geoms[crossing] = shapely.intersection(geoms[crossing], sd_geom)
+    mtbs_clipped = candidates.set_geometry(gpd.GeoSeries(geoms, index=candidates.index, crs=candidates.crs))
+    mtbs_clipped = mtbs_clipped[~mtbs_clipped.geometry.is_empty]
     
     if mtbs_clipped.empty:
         print("WARNING: The clipped dataset is empty! No fires found within the SD County boundary.")
@@ -55,6 +68,14 @@ def filter_county(input_path: Path, sd_county: gpd.GeoDataFrame) -> gpd.GeoDataF
     return mtbs_clipped
 
 
+def ignition_years(dates) -> np.ndarray:
+    """
+    Calendar year of each ignition date, computed on datetime64 (no per-row Python).
+    Accepts datetime64 columns as well as python date objects.
+    """
+    return np.asarray(dates, dtype='datetime64[D]').astype('datetime64[Y]').astype(np.int64) + 1970
+
+
 def filter_data(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     """
     Filter the MTBS dataset to events between START_YEAR-END_YEAR and labeled as 'Wildfire'.
@@ -64,17 +85,15 @@ def filter_data(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     # Ensure Ig_Date is datetime
     gdf['Ig_Date'] = pd.to_datetime(gdf['Ig_Date'])
     
-    # Filter by year between START_YEAR and END_YEAR
-    date_filter = (gdf['Ig_Date'].dt.year >= START_YEAR) & (gdf['Ig_Date'].dt.year <= END_YEAR)
+    # Filter by year between START_YEAR and END_YEAR, then by Incident Type equals 'Wildfire' (one mask, updated in place)
+    years = ignition_years(gdf['Ig_Date'])
+    mask = years >= START_YEAR
+    mask &= years <= END_YEAR
+    mask &= gdf['Incid_Type'].to_numpy() == 'Wildfire'
     
-    # Filter by Incident Type equals 'Wildfire'
-    type_filter = gdf['Incid_Type'] == 'Wildfire'
-    
-    # Apply both filters
-    filtered_gdf = gdf[date_filter & type_filter].copy()
-    
-    # Convert back to python date objects
-    filtered_gdf['Ig_Date'] = filtered_gdf['Ig_Date'].dt.date
+    # Apply the filter and convert back to python date objects; loc already returns a new frame
+    filtered_gdf = gdf.loc[mask]
+    filtered_gdf = filtered_gdf.assign(Ig_Date=filtered_gdf['Ig_Date'].dt.date)
     
     print(f"Filtering complete. Reduced from {len(gdf)} to {len(filtered_gdf)} records.")
     return filtered_gdf
@@ -101,31 +120,28 @@ def rasterize_data(gdf: gpd.GeoDataFrame, reference_path: Path, output_dir: Path
     
     print(f"Processing {len(dates)} months...")
     
+    # Rasterize each month that has fires once, grouping fires by ignition month up front.
+    # Months stay separate rasters: a pixel burned in two different months must appear in both.
+    fire_months = pd.to_datetime(gdf['Ig_Date']).dt.to_period('M')
+    monthly_rasters = {}
+    for month, monthly_fires in gdf.groupby(fire_months, sort=False):
+        # shapes must be (geometry, value) or just geometry (if default_value used);
+        # pass the shapely array as-is and let default_value burn every fire as 1
+        monthly_rasters[month] = features.rasterize(
+            shapes=monthly_fires.geometry.values,
+            out_shape=out_shape,
+            transform=transform,
+            fill=0,
+            default_value=1,
+            dtype=np.uint8
+        )
+    
+    # Months without fires share one empty grid
+    empty_raster = np.zeros(out_shape, dtype=np.uint8)
+    
     for date in tqdm(dates):
-        # Define the month's range
-        month_start = date.date()
-        month_end = (date + pd.offsets.MonthEnd(0)).date()
+        raster = monthly_rasters.get(date.to_period('M'), empty_raster)
         
-        # Filter fires that started in this month
-        monthly_fires = gdf[gdf['Ig_Date'].apply(lambda d: (d.year == date.year) and (d.month == date.month))]
-        
-        if not monthly_fires.empty:
-            # Rasterize
-            # shapes must be (geometry, value) or just geometry (if default_value used)
-            shapes = [(geom, 1) for geom in monthly_fires.geometry]
-            
-            raster = features.rasterize(
-                shapes=shapes,
-                out_shape=out_shape,
-                transform=transform,
-                fill=0,
-                default_value=1,
-                dtype=np.uint8
-            )
-        else:
-            # Create empty grid
-            raster = np.zeros(out_shape, dtype=np.uint8)
-            
         # Save as NetCDF
         # Create xarray DataArray
         da = xr.DataArray(
@@ -142,12 +158,40 @@ def rasterize_data(gdf: gpd.GeoDataFrame, reference_path: Path, output_dir: Path
         da.rio.write_crs(crs, inplace=True)
         da.rio.write_transform(transform, inplace=True)
         
+        # Single-chunk, lightly compressed uint8; most months are all zeros
+        da.encoding.update({'dtype': 'uint8', 'zlib': True, 'complevel': 1, 'shuffle': True, 'chunksizes': da.shape})
+        
         output_filename = f"sd_mtbs_800m_{date.strftime('%Y%m')}.nc"
         da.to_netcdf(output_dir / output_filename)
         
     print(f"Rasterization complete. Saved {len(dates)} files to {output_dir}")
 
 
+def check_raster(file_path: Path, ref_shape, ref_crs, ref_transform):
+    """
+    Check one monthly raster against the reference grid. Returns a failure message, or None if it passes.
+    """
+    with rioxarray.open_rasterio(file_path) as ds:
+        # Check Shape
+        if ds.shape[-2:] != ref_shape:
+            return f"Shape mismatch. Output: {ds.shape[-2:]}, Reference: {ref_shape}"
+
+        # Check CRS
+        if ds.rio.crs != ref_crs:
+            return "CRS mismatch."
+
+        # Check Transform (Grid alignment)
+        if ds.rio.transform() != ref_transform:
+            return "Transform mismatch (grid misalignment)."
+
+        # Check Values (should be 0 or 1); only sort out the offending values on failure
+        values = ds.values
+        if ((values != 0) & (values != 1)).any():
+            return f"Found unexpected values in raster: {np.unique(values)}. Expected only 0 and 1."
+
+    return None
+
+
 def verify_rasterize(output_dir: Path, reference_path: Path):
     """
     Verify the rasterized outputs.
@@ -163,43 +207,29 @@ def verify_rasterize(output_dir: Path, reference_path: Path):
         print("FAILED: No NetCDF files found in output directory.")
         return
         
-    # Load reference for comparison
+    # Load reference for comparison, reading its grid properties once
     ref_grid = rioxarray.open_rasterio(reference_path)
+    ref_shape = ref_grid.shape[-2:]
+    ref_crs = ref_grid.rio.crs
+    ref_transform = ref_grid.rio.transform()
     
-    # Check all files with progress bar
+    # Check all files concurrently (file opens are I/O bound) with progress bar
     all_passed = True
-    for file_path in tqdm(files, desc="Verifying files"):
-        try:
-            ds = rioxarray.open_rasterio(file_path)
-            
-            # Check Shape
-            if ds.shape[-2:] != ref_grid.shape[-2:]:
-                 print(f"FAILED {file_path.name}: Shape mismatch. Output: {ds.shape[-2:]}, Reference: {ref_grid.shape[-2:]}")
-                 all_passed = False
-                 continue
-
-            # Check CRS
-            if ds.rio.crs != ref_grid.rio.crs:
-                 print(f"FAILED {file_path.name}: CRS mismatch.")
-                 all_passed = False
-                 continue
-                 
-            # Check Transform (Grid alignment)
-            if ds.rio.transform() != ref_grid.rio.transform():
-                 print(f"FAILED {file_path.name}: Transform mismatch (grid misalignment).")
-                 all_passed = False
-                 continue
-                 
-            # Check Values (should be 0 or 1)
-            unique_vals = np.unique(ds.values)
-            if not np.all(np.isin(unique_vals, [0, 1])):
-                 print(f"FAILED {file_path.name}: Found unexpected values in raster: {unique_vals}. Expected only 0 and 1.")
-                 all_passed = False
-                 continue
-                 
-        except Exception as e:
-            print(f"FAILED {file_path.name}: Error verifying raster: {e}")
-            all_passed = False
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        future_to_path = {
+            executor.submit(check_raster, file_path, ref_shape, ref_crs, ref_transform): file_path
+            for file_path in files
+        }
+        for future in tqdm(as_completed(future_to_path), total=len(future_to_path), desc="Verifying files"):
+            file_path = future_to_path[future]
+            try:
+                failure = future.result()
+                if failure is not None:
+                    print(f"FAILED {file_path.name}: {failure}")
+                    all_passed = False
+            except Exception as e:
+                print(f"FAILED {file_path.name}: Error verifying raster: {e}")
+                all_passed = False
     
     if all_passed:
         print(f"SUCCESS: Raster verification passed. All {len(files)} files match PRISM 800m grid.")
@@ -250,7 +280,7 @@ def verify_output(gdf: gpd.GeoDataFrame):
         return
 
     # Check Filters
-    years = gdf['Ig_Date'].apply(lambda d: d.year)
+    years = ignition_years(gdf['Ig_Date'])
     invalid_dates = gdf[~((years >= START_YEAR) & (years <= END_YEAR))]
     
     if not invalid_dates.empty:
@@ -281,7 +311,7 @@ def main():
     
     # 3. Load Data
     # Read the San Diego County shapefile
-    sd_county = gpd.read_file(SD_COUNTY_PATH)
+    sd_county = gpd.read_file(SD_COUNTY_PATH, use_arrow=True)
     print(f"Loaded SD County boundary. CRS: {sd_county.crs}")
 
     # 4. Clip to County
@@ -1,12 +1,15 @@
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 from pathlib import Path
 import rioxarray
 import xarray as xr
 import geopandas as gpd
 from tqdm import tqdm
 import numpy as np
-from shapely.geometry import mapping
 import rasterio
+from shapely.geometry import mapping
+import threading
 from datetime import datetime, timedelta
 
 # Constants
@@ -17,6 +20,22 @@ OUTPUT_DIR = DATA_DIR / "nasa_ndvi"
 PRISM_REF_PATH = DATA_DIR / "prism_climate" / "ppt" / "sd_prism_ppt_us_30s_200201.nc"
 SD_COUNTY_PATH = DATA_DIR / "sd_county" / "sd_county.shp"
 
+# SD county geometries per raster CRS, shared by all worker threads
+_SD_GEOMS = {}
+SD_GEOMS_LOCK = threading.Lock()
+
+def sd_geometries(sd_county: gpd.GeoDataFrame, crs):
+    """
+    Return the SD county dissolved to one GeoJSON-like mapping in the given CRS,
+    plus its total bounds. Reprojection runs once per CRS rather than once per file.
+    """
+    key = crs.to_wkt()
+    with SD_GEOMS_LOCK:
+        if key not in _SD_GEOMS:
+            sd_county_proj = sd_county.to_crs(crs) if sd_county.crs != crs else sd_county
+            _SD_GEOMS[key] = ([mapping(sd_county_proj.union_all())], sd_county_proj.total_bounds)
+        return _SD_GEOMS[key]
+
 def process_file(file_path: Path, reference_grid: xr.DataArray, sd_county: gpd.GeoDataFrame, output_dir: Path):
     """
     Process a single NDVI file: clip to SD County and regrid to match reference grid.
@@ -24,14 +43,11 @@ def process_file(file_path: Path, reference_grid: xr.DataArray, sd_county: gpd.G
     try:
         rds = rioxarray.open_rasterio(file_path, masked=True)
         
-        # Ensure we have the right CRS for the vector before clipping
-        if sd_county.crs != rds.rio.crs:
-            sd_county_proj = sd_county.to_crs(rds.rio.crs)
-        else:
-            sd_county_proj = sd_county
+        # Ensure we have the right CRS for the vector before clipping (cached per CRS)
+        sd_geoms, sd_bounds = sd_geometries(sd_county, rds.rio.crs)
 
-        # Clip to San Diego County
-        clipped = rds.rio.clip(sd_county_proj.geometry.apply(mapping), sd_county_proj.crs)
+        # Crop to the county's bounding box first, then mask the small window by the polygon
+        clipped = rds.rio.clip_box(*sd_bounds).rio.clip(sd_geoms, rds.rio.crs)
 
         # Reproject/Regrid to match PRISM grid
         regridded = clipped.rio.reproject_match(
@@ -57,12 +73,35 @@ def process_file(file_path: Path, reference_grid: xr.DataArray, sd_county: gpd.G
         output_filename = f"sd_ndvi_800m_{date_str}.nc"
         output_path = output_dir / output_filename
         
-        # Save to NetCDF
+        # Save to NetCDF as one lightly compressed chunk (the SD grid is small)
+        regridded.encoding.update({'zlib': True, 'complevel': 1, 'shuffle': True, 'chunksizes': regridded.shape})
         regridded.to_netcdf(output_path)
         
     except Exception as e:
         print(f"Error processing {file_path.name}: {e}")
 
+def check_output(file_path: Path, ref_shape, ref_crs, ref_bounds):
+    """
+    Check one output file's header against the reference grid. Returns a failure message, or None if it passes.
+    """
+    with rioxarray.open_rasterio(file_path) as ds:
+        # Check Shape
+        if ds.shape != ref_shape:
+            return f"Shape mismatch {ds.shape} != {ref_shape}"
+
+        # Check CRS
+        if ds.rio.crs != ref_crs:
+            return "CRS mismatch"
+
+        # Check Bounds (Overlap with reference)
+        r_bounds = ds.rio.bounds()
+
+    overlap = not (r_bounds[2] < ref_bounds[0] or r_bounds[0] > ref_bounds[2] or r_bounds[3] < ref_bounds[1] or r_bounds[1] > ref_bounds[3])
+    if not overlap:
+        return "Bounds do not overlap with reference"
+
+    return None
+
 def verify_outputs(output_dir: Path, reference_grid: xr.DataArray):
     """
     Verify all generated files in output_dir.
@@ -72,37 +111,24 @@ def verify_outputs(output_dir: Path, reference_grid: xr.DataArray):
         print("FAILED to verify outputs: No output files found.")
         return
 
-    all_passed = True
-    for file_path in tqdm(files, desc="Verifying output files"):
-        try:
-            ds = rioxarray.open_rasterio(file_path)
-            
-            # Check Shape
-            if ds.shape != reference_grid.shape:
-                print(f"FAILED {file_path.name}: Shape mismatch {ds.shape} != {reference_grid.shape}")
-                all_passed = False
-                continue
+    ref_shape = reference_grid.shape
+    ref_crs = reference_grid.rio.crs
+    ref_bounds = reference_grid.rio.bounds()
 
-            # Check CRS
-            if ds.rio.crs != reference_grid.rio.crs:
-                print(f"FAILED {file_path.name}: CRS mismatch")
+    # Only headers are read, so the file opens run concurrently
+    all_passed = True
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        future_to_path = {executor.submit(check_output, file_path, ref_shape, ref_crs, ref_bounds): file_path for file_path in files}
+        for future in tqdm(as_completed(future_to_path), total=len(future_to_path), desc="Verifying output files"):
+            file_path = future_to_path[future]
+            try:
+                failure = future.result()
+                if failure is not None:
+                    print(f"FAILED {file_path.name}: {failure}")
+                    all_passed = False
+            except Exception as e:
+                print(f"FAILED {file_path.name}: Error opening file - {e}")
                 all_passed = False
-                continue
-                
-            # Check Bounds (Overlap with reference)
-            r_bounds = ds.rio.bounds()
-            ref_bounds = reference_grid.rio.bounds()
-            
-            overlap = not (r_bounds[2] < ref_bounds[0] or r_bounds[0] > ref_bounds[2] or r_bounds[3] < ref_bounds[1] or r_bounds[1] > ref_bounds[3])
-            
-            if not overlap:
-                 print(f"FAILED {file_path.name}: Bounds do not overlap with reference")
-                 all_passed = False
-                 continue
-
-        except Exception as e:
-            print(f"FAILED {file_path.name}: Error opening file - {e}")
-            all_passed = False
     
     if all_passed:
         print(f"SUCCESS: All {len(files)} files passed verification.")
@@ -124,7 +150,7 @@ def main():
 
     print("Loading reference data...")
     prism_ref = rioxarray.open_rasterio(PRISM_REF_PATH)
-    sd_county = gpd.read_file(SD_COUNTY_PATH)
+    sd_county = gpd.read_file(SD_COUNTY_PATH, use_arrow=True)
 
     # Find input files
     input_files = list(INPUT_DIR.glob("MOD13A3*NDVI*.tif"))
@@ -134,9 +160,11 @@ def main():
     max_workers = 5
     num_workers = min(max_workers, total_files)
 
+    # Files are independent and GDAL releases the GIL, so threads run them concurrently
     print("Processing files...")
-    for file_path in tqdm(input_files):
-        process_file(file_path, prism_ref, sd_county, OUTPUT_DIR)
+    worker = partial(process_file, reference_grid=prism_ref, sd_county=sd_county, output_dir=OUTPUT_DIR)
+    with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+        list(tqdm(executor.map(worker, input_files), total=total_files))
 
     verify_outputs(OUTPUT_DIR, prism_ref)
 
@@ -1,10 +1,16 @@
-import xarray as xr
+import netCDF4
 import polars as pl
+import numpy as np
 from pathlib import Path
 import re
+import json
 from tqdm import tqdm
-import gc
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from contextlib import contextmanager
+import threading
 import os
+import shutil
 
 # Constants
 DATA_DIR = Path(__file__).resolve().parent.parent.parent / "data" / "quarter_2"
@@ -13,10 +19,28 @@ MTBS_DIR = DATA_DIR / "ca_mbts"
 NDVI_DIR = DATA_DIR / "ca_nasa_ndvi"
 NLCD_DIR = DATA_DIR / "ca_nlcd_annual"
 DEM_DIR = DATA_DIR / "ca_usgs_dem"
-OUTPUT_FILE = DATA_DIR / "ca_combined_data.parquet"
+OUTPUT_FILE = DATA_DIR / "ca_combined_data.parquet"  # Hive-partitioned directory (year=YYYY/)
 TEMP_DIR = DATA_DIR / "ca_temp"
+STAGING_DIR = TEMP_DIR / "ca_combined_data.parquet"
+INDEX_FILE = DATA_DIR / "ca_file_index.json"
 START_YEAR = 2000
 END_YEAR = 2024
+ROW_GROUP_SIZE = 1_000_000
+ZSTD_LEVEL = 3
+MAX_WORKERS = 8
+MONTH_WORKERS = 4
+COORD_SCALE = 100_000  # lat/lon are joined as int32 codes at 5-decimal precision
+
+# Source file name patterns
+PRISM_PATTERN = re.compile(r"ca_prism_([a-z]+)_us_30s_(\d{4})(\d{2})\.nc$")
+MTBS_PATTERN = re.compile(r"ca_mbts_800m_(\d{4})(\d{2})\.nc$")
+NDVI_PATTERN = re.compile(r"ca_ndvi_800m_(\d{4})-(\d{2})-(\d{2})\.nc$")
+NLCD_PREFIX = "Annual_NLCD_LndCov_"
+NLCD_SUFFIX = "_CU_C1V1_800m.nc"
+NLCD_NAME_LENGTH = len(NLCD_PREFIX) + 4 + len(NLCD_SUFFIX)
+
+NETCDF_LOCK = threading.Lock()
+_GRID = None
 
 def ensure_temp_dir():
     """Create temp directory for intermediate files."""
@@ -24,290 +48,348 @@ def ensure_temp_dir():
 
 def cleanup_temp_dir():
     """Remove temp directory and its contents."""
-    import shutil
     if TEMP_DIR.exists():
         shutil.rmtree(TEMP_DIR)
 
-def delete_files(file_list):
-    """Delete a list of files."""
-    for f in file_list:
-        try:
-            os.remove(f)
-        except OSError:
-            pass
+def list_nc_files(directory, recursive=False):
+    """Yield (name, path) for .nc files under a directory via os.scandir (no Path/stat per entry)."""
+    if not os.path.isdir(directory):
+        return
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if recursive and entry.is_dir():
+                yield from list_nc_files(entry.path, recursive=True)
+            elif entry.name.endswith('.nc'):
+                yield entry.name, entry.path
 
 def get_prism_files(var_name):
     """Get list of PRISM files for a variable and extract year-month."""
     files = []
-    var_dir = PRISM_DIR / var_name
-    if not var_dir.exists():
-        return []
-    
-    pattern = re.compile(rf"ca_prism_{var_name}_us_30s_(\d{{4}})(\d{{2}})\.nc$")
-    
-    for file_path in var_dir.glob("*.nc"):
-        match = pattern.search(file_path.name)
-        if match:
-            year = int(match.group(1))
+    for name, path in list_nc_files(PRISM_DIR / var_name):
+        match = PRISM_PATTERN.search(name)
+        if match and match.group(1) == var_name:
+            year = int(match.group(2))
             if START_YEAR <= year <= END_YEAR:
-                month = int(match.group(2))
-                files.append((file_path, year, month))
+                month = int(match.group(3))
+                files.append((Path(path), year, month))
             
     return sorted(files, key=lambda x: (x[1], x[2]))
 
-def process_single_prism_file(file_path, var_name, year, month):
-    """Process a single PRISM file and return a Polars DataFrame."""
-    with xr.open_dataset(file_path) as ds:
-        pdf = ds.to_dataframe().reset_index()
-        
-        if 'Band1' in pdf.columns:
-            pdf = pdf.rename(columns={'Band1': var_name})
-        
-        if 'y' in pdf.columns and 'x' in pdf.columns:
-            pdf = pdf.rename(columns={'y': 'lat', 'x': 'lon'})
-        
-        if var_name in pdf.columns:
-            df = pl.from_pandas(pdf[['lat', 'lon', var_name]].copy())
-            df = df.with_columns([
-                pl.col('lat').round(5),
-                pl.col('lon').round(5),
-                pl.lit(year).alias('year').cast(pl.Int32),
-                pl.lit(month).alias('month').cast(pl.Int32)
-            ])
-            return df
-    return None
+@contextmanager
+def open_grid(file_path):
+    """Open a NetCDF file with netCDF4 directly (masking/scaling on, no xarray decoding)."""
+    # The netCDF-C library is not thread-safe, so reads from the year workers are serialized
+    with NETCDF_LOCK, netCDF4.Dataset(file_path, 'r') as ds:
+        ds.set_always_mask(False)
+        yield ds
+
+def grid_data_vars(ds):
+    """List the gridded data variables in a netCDF4 Dataset (skips coordinates and spatial_ref)."""
+    return [v for v in ds.variables if v not in ds.dimensions and v != 'spatial_ref']
+
+def build_grid(y, x):
+    """Build the flattened lat/lon Series for a y/x grid as int32 codes (degrees * COORD_SCALE)."""
+    lat_i = np.rint(y * COORD_SCALE).astype(np.int32)
+    lon_i = np.rint(x * COORD_SCALE).astype(np.int32)
+    return {
+        'y': y,
+        'x': x,
+        'lat': pl.Series('lat', np.repeat(lat_i, x.size)),
+        'lon': pl.Series('lon', np.tile(lon_i, y.size)),
+    }
+
+def _load_grid(file_path):
+    """Cache the shared 800m grid from a representative PRISM file."""
+    global _GRID
+    with open_grid(file_path) as ds:
+        _GRID = build_grid(np.asarray(ds['y'][:]), np.asarray(ds['x'][:]))
+    return _GRID
+
+def grid_coords(ds):
+    """Read the 1-D y/x coordinate arrays from a netCDF4 Dataset."""
+    return np.asarray(ds['y'][:]), np.asarray(ds['x'][:])
+
+def grid_values(ds, data_var):
+    """Read a gridded variable as a flat y-major array, with masked cells as NaN."""
+    var = ds[data_var]
+    values = var[:]
+    # Masked (_FillValue) cells become NaN, then null, as with xarray's decode_cf
+    if np.ma.isMaskedArray(values):
+        values = values.astype(np.result_type(values.dtype, np.float32)).filled(np.nan)
+    dims = var.dimensions
+    return np.moveaxis(values, [dims.index('y'), dims.index('x')], [-2, -1]).ravel()
+
+def grid_frame(y, x, columns):
+    """Attach flat value arrays (column name -> array) to the lat/lon of a y/x grid."""
+    # Every source is on the PRISM grid, so reuse the cached lat/lon unless this grid differs
+    grid = _GRID
+    if grid is None or not (np.array_equal(y, grid['y']) and np.array_equal(x, grid['x'])):
+        grid = build_grid(y, x)
+    data = {
+        'lat': grid['lat'],
+        'lon': grid['lon'],
+    }
+    for column, values in columns.items():
+        data[column] = pl.Series(column, values, nan_to_null=True)
+    return pl.DataFrame(data)
+
+def grid_to_polars(ds, columns):
+    """Flatten gridded variables into a lat/lon Polars DataFrame straight from the NetCDF arrays.
+
+    columns maps each data variable in ds to its output column name.
+    """
+    y, x = grid_coords(ds)
+    return grid_frame(y, x, {column: grid_values(ds, data_var) for data_var, column in columns.items()})
+
+def process_prism_month(year, month, var_files, vars_list):
+    """Stack one month of PRISM variables into a single DataFrame by grid position (no joins)."""
+    columns = {}
+    y = x = None
+    for var in vars_list:
+        with open_grid(var_files[var]) as ds:
+            if 'Band1' not in ds.variables:
+                return None
+            var_y, var_x = grid_coords(ds)
+            if y is None:
+                y, x = var_y, var_x
+            elif not (np.array_equal(var_y, y) and np.array_equal(var_x, x)):
+                raise ValueError(f"PRISM {var} grid differs for {year}-{month:02d}")
+            columns[var] = grid_values(ds, 'Band1')
+    
+    df = grid_frame(y, x, columns)
+    df = df.with_columns([
+        *[pl.col(var).cast(pl.Float32) for var in vars_list],
+        pl.lit(year).alias('year').cast(pl.UInt16),
+        pl.lit(month).alias('month').cast(pl.UInt8)
+    ])
+    return df
 
 def process_prism_year(year, files_by_month, vars_list):
-    """Process all PRISM data for a single year, return yearly parquet path."""
-    monthly_parquet_files = []
+    """Process all PRISM data for a single year, return a dict of month -> DataFrame."""
+    months = [m for m in sorted(files_by_month.keys()) if len(files_by_month[m]) == len(vars_list)]
     
-    for month in sorted(files_by_month.keys()):
-        var_files = files_by_month[month]
-        
-        if len(var_files) != len(vars_list):
-            continue
-        
-        combined = None
-        for var in vars_list:
-            df = process_single_prism_file(var_files[var], var, year, month)
-            if df is None:
-                continue
-                
-            if combined is None:
-                combined = df
-            else:
-                combined = combined.join(
-                    df.select(['lat', 'lon', var]),
-                    on=['lat', 'lon'],
-                    how='left'
-                )
-        
-        if combined is not None:
-            temp_file = TEMP_DIR / f"prism_{year}_{month:02d}.parquet"
-            combined.write_parquet(temp_file)
-            monthly_parquet_files.append(temp_file)
-            del combined
-            gc.collect()
+    # Months are independent; file reads are serialized by NETCDF_LOCK, frame building overlaps
+    with ThreadPoolExecutor(max_workers=MONTH_WORKERS) as executor:
+        dfs = list(executor.map(lambda m: process_prism_month(year, m, files_by_month[m], vars_list), months))
     
-    if monthly_parquet_files:
-        yearly_combined = pl.concat([pl.scan_parquet(f) for f in monthly_parquet_files]).collect()
-        yearly_file = TEMP_DIR / f"prism_year_{year}.parquet"
-        yearly_combined.write_parquet(yearly_file)
-        del yearly_combined
-        gc.collect()
-        delete_files(monthly_parquet_files)
-        return yearly_file
-    return None
+    return {month: df for month, df in zip(months, dfs) if df is not None}
+
+def read_first_var(file_path, column):
+    """Read the first data variable of a NetCDF file as a lat/lon DataFrame, or None if it has none."""
+    with open_grid(file_path) as ds:
+        data_vars = grid_data_vars(ds)
+        if not data_vars:
+            return None
+        y, x = grid_coords(ds)
+        values = grid_values(ds, data_vars[0])
+    
+    # Build the frame outside the lock so other workers can read meanwhile
+    return grid_frame(y, x, {column: values})
 
 def process_mtbs_year(year, files_by_month):
-    """Process all MTBS data for a single year, return yearly parquet path."""
-    monthly_parquet_files = []
+    """Process all MTBS data for a single year, return a dict of month -> DataFrame."""
+    months = sorted(files_by_month.keys())
     
-    for month in sorted(files_by_month.keys()):
-        file_path = files_by_month[month]
-        with xr.open_dataset(file_path) as ds:
-            pdf = ds.to_dataframe().reset_index()
-            data_vars = list(ds.data_vars)
-            if data_vars:
-                pdf = pdf.rename(columns={data_vars[0]: 'burned_area'})
-            
-            if 'y' in pdf.columns and 'x' in pdf.columns:
-                pdf = pdf.rename(columns={'y': 'lat', 'x': 'lon'})
-            
-            if 'burned_area' in pdf.columns:
-                df = pl.from_pandas(pdf[['lat', 'lon', 'burned_area']].copy())
-                df = df.with_columns([
-                    pl.col('lat').round(5),
-                    pl.col('lon').round(5),
-                    pl.lit(year).alias('year').cast(pl.Int32),
-                    pl.lit(month).alias('month').cast(pl.Int32)
-                ])
-                temp_file = TEMP_DIR / f"mtbs_{year}_{month:02d}.parquet"
-                df.write_parquet(temp_file)
-                monthly_parquet_files.append(temp_file)
-                del df
-                gc.collect()
+    with ThreadPoolExecutor(max_workers=MONTH_WORKERS) as executor:
+        dfs = list(executor.map(lambda m: read_first_var(files_by_month[m], 'burned_area'), months))
     
-    if monthly_parquet_files:
-        yearly_combined = pl.concat([pl.scan_parquet(f) for f in monthly_parquet_files]).collect()
-        yearly_file = TEMP_DIR / f"mtbs_year_{year}.parquet"
-        yearly_combined.write_parquet(yearly_file)
-        del yearly_combined
-        gc.collect()
-        delete_files(monthly_parquet_files)
-        return yearly_file
-    return None
+    return {month: df.with_columns(pl.col('burned_area').cast(pl.UInt8))
+            for month, df in zip(months, dfs) if df is not None}
 
 def process_ndvi_year(year, files_by_month):
-    """Process all NDVI data for a single year, return yearly parquet path."""
-    monthly_parquet_files = []
+    """Process all NDVI data for a single year, return a dict of month -> DataFrame."""
+    months = sorted(files_by_month.keys())
     
-    for month in sorted(files_by_month.keys()):
-        file_path = files_by_month[month]
-        with xr.open_dataset(file_path) as ds:
-            pdf = ds.to_dataframe().reset_index()
-            data_vars = [v for v in ds.data_vars if v != 'spatial_ref']
-            
-            if data_vars:
-                pdf = pdf.rename(columns={data_vars[0]: 'ndvi'})
-            
-            if 'y' in pdf.columns and 'x' in pdf.columns:
-                pdf = pdf.rename(columns={'y': 'lat', 'x': 'lon'})
-            
-            if 'ndvi' in pdf.columns:
-                df = pl.from_pandas(pdf[['lat', 'lon', 'ndvi']].copy())
-                df = df.with_columns([
-                    pl.col('lat').round(5),
-                    pl.col('lon').round(5),
-                    pl.lit(year).alias('year').cast(pl.Int32),
-                    pl.lit(month).alias('month').cast(pl.Int32)
-                ])
-                temp_file = TEMP_DIR / f"ndvi_{year}_{month:02d}.parquet"
-                df.write_parquet(temp_file)
-                monthly_parquet_files.append(temp_file)
-                del df
-                gc.collect()
+    with ThreadPoolExecutor(max_workers=MONTH_WORKERS) as executor:
+        dfs = list(executor.map(lambda m: read_first_var(files_by_month[m], 'ndvi'), months))
     
-    if monthly_parquet_files:
-        yearly_combined = pl.concat([pl.scan_parquet(f) for f in monthly_parquet_files]).collect()
-        yearly_file = TEMP_DIR / f"ndvi_year_{year}.parquet"
-        yearly_combined.write_parquet(yearly_file)
-        del yearly_combined
-        gc.collect()
-        delete_files(monthly_parquet_files)
-        return yearly_file
-    return None
+    return {month: df.with_columns(pl.col('ndvi').cast(pl.Float32))
+            for month, df in zip(months, dfs) if df is not None}
 
 def process_nlcd_year(year, file_path):
-    """Process NLCD data for a single year, return parquet path."""
-    with xr.open_dataset(file_path) as ds:
-        pdf = ds.to_dataframe().reset_index()
-        data_vars = [v for v in ds.data_vars if v != 'spatial_ref']
+    """Process NLCD data for a single year, return a DataFrame."""
+    with open_grid(file_path) as ds:
+        data_vars = grid_data_vars(ds)
         
         if data_vars:
-            pdf = pdf.rename(columns={data_vars[0]: 'landcover'})
-        
-        if 'y' in pdf.columns and 'x' in pdf.columns:
-            pdf = pdf.rename(columns={'y': 'lat', 'x': 'lon'})
-        
-        if 'landcover' in pdf.columns:
-            df = pl.from_pandas(pdf[['lat', 'lon', 'landcover']].copy())
-            df = df.with_columns([
-                pl.col('lat').round(5),
-                pl.col('lon').round(5),
-                pl.lit(year).alias('year').cast(pl.Int32)
-            ])
-            yearly_file = TEMP_DIR / f"nlcd_year_{year}.parquet"
-            df.write_parquet(yearly_file)
-            del df
-            gc.collect()
-            return yearly_file
+            df = grid_to_polars(ds, {data_vars[0]: 'landcover'})
+            return df.with_columns(pl.col('landcover').cast(pl.UInt8))
     return None
 
 def load_dem():
-    """Load DEM data once (static, no year dependency). Returns parquet path."""
+    """Load DEM data once (static, no year dependency). Returns an in-memory DataFrame."""
     file_path = DEM_DIR / "usgs_dem_800m.nc"
     if not file_path.exists():
         raise FileNotFoundError(f"DEM file not found: {file_path}")
         
-    with xr.open_dataset(file_path) as ds:
-        pdf = ds.to_dataframe().reset_index()
-        
-        if 'y' in pdf.columns and 'x' in pdf.columns:
-            pdf = pdf.rename(columns={'y': 'lat', 'x': 'lon'})
-            
-        cols = ['lat', 'lon', 'elevation', 'slope', 'aspect']
-        df = pl.from_pandas(pdf[cols].copy())
-        df = df.with_columns([
-            pl.col('lat').round(5),
-            pl.col('lon').round(5)
-        ])
+    with open_grid(file_path) as ds:
+        dem_vars = ['elevation', 'slope', 'aspect']
+        df = grid_to_polars(ds, {v: v for v in dem_vars})
+        df = df.with_columns([pl.col(v).cast(pl.Float32) for v in dem_vars])
     
-    dem_file = TEMP_DIR / "dem.parquet"
-    df.write_parquet(dem_file)
-    del df
-    gc.collect()
+    return df
+
+def attach_columns(base, other, columns):
+    """Add other's columns (name -> dtype) to base, by position when both share the same grid."""
+    if other is None:
+        return base.with_columns([pl.lit(None, dtype=dtype).alias(c) for c, dtype in columns.items()])
     
-    return dem_file
+    # Sources are flattened in the same grid order, so matching keys means rows already line up
+    if other.height == base.height and other['lat'].equals(base['lat']) and other['lon'].equals(base['lon']):
+        return pl.concat([base, other.select(list(columns))], how='horizontal')
+    
+    return base.join(other.select(['lat', 'lon', *columns]), on=['lat', 'lon'], how='left')
 
-def merge_year_data(year, prism_file, mtbs_file, ndvi_file, nlcd_file, dem_file):
-    """Merge all data for a single year. Returns merged parquet path."""
-    # Start with PRISM as base
-    combined = pl.scan_parquet(prism_file)
+def merge_year_data(year, prism_months, mtbs_months, ndvi_months, nlcd_df, dem_df):
+    """Stitch all data for a single year onto the PRISM months. Returns the year's partition file."""
+    monthly_dfs = []
+    for month, combined in sorted(prism_months.items()):
+        # MTBS and NDVI (year, month)
+        combined = attach_columns(combined, mtbs_months.get(month), {'burned_area': pl.UInt8})
+        combined = attach_columns(combined, ndvi_months.get(month), {'ndvi': pl.Float32})
+        
+        # NLCD (year) and DEM (static)
+        combined = attach_columns(combined, nlcd_df, {'landcover': pl.UInt8})
+        combined = attach_columns(combined, dem_df, {'elevation': pl.Float32, 'slope': pl.Float32, 'aspect': pl.Float32})
+        monthly_dfs.append(combined)
     
-    # Join MTBS (year, month join)
-    if mtbs_file:
-        combined = combined.join(
-            pl.scan_parquet(mtbs_file),
-            on=['lat', 'lon', 'year', 'month'],
-            how='left'
-        )
+    # Restore float lat/lon from the int32 join keys; year is carried by the partition path
+    result = pl.concat(monthly_dfs).with_columns([
+        (pl.col('lat') / COORD_SCALE).alias('lat'),
+        (pl.col('lon') / COORD_SCALE).alias('lon')
+    ]).drop('year')
     
-    # Join NDVI (year, month join)
-    if ndvi_file:
-        combined = combined.join(
-            pl.scan_parquet(ndvi_file),
-            on=['lat', 'lon', 'year', 'month'],
-            how='left'
-        )
+    # Write straight into the staged Hive partition (year=YYYY/) of the final dataset
+    year_dir = STAGING_DIR / f"year={year}"
+    year_dir.mkdir(parents=True, exist_ok=True)
+    merged_file = year_dir / "data.parquet"
+    result.write_parquet(merged_file, compression='zstd', compression_level=ZSTD_LEVEL,
+                         row_group_size=ROW_GROUP_SIZE, statistics=True)
     
-    # Join NLCD (year join - need to drop month from NLCD or just join on lat/lon/year)
-    if nlcd_file:
-        combined = combined.join(
-            pl.scan_parquet(nlcd_file),
-            on=['lat', 'lon', 'year'],
-            how='left'
-        )
+    return merged_file
+
+def process_year(year, prism_by_year, mtbs_by_year, ndvi_by_year, nlcd_by_year, vars_list, dem_df):
+    """Run the full pipeline for one year. Returns merged parquet path or None if no PRISM data."""
+    # Process PRISM for this year
+    prism_months = {}
+    if year in prism_by_year:
+        prism_months = process_prism_year(year, prism_by_year[year], vars_list)
     
-    # Join DEM (static, lat/lon join)
-    if dem_file:
-        combined = combined.join(
-            pl.scan_parquet(dem_file),
-            on=['lat', 'lon'],
-            how='left'
-        )
+    if not prism_months:
+        return None
     
-    # Collect and save
-    result = combined.collect()
-    merged_file = TEMP_DIR / f"merged_year_{year}.parquet"
-    result.write_parquet(merged_file)
-    del result
-    gc.collect()
+    # Process MTBS for this year
+    mtbs_months = {}
+    if year in mtbs_by_year:
+        mtbs_months = process_mtbs_year(year, mtbs_by_year[year])
     
-    return merged_file
+    # Process NDVI for this year
+    ndvi_months = {}
+    if year in ndvi_by_year:
+        ndvi_months = process_ndvi_year(year, ndvi_by_year[year])
+    
+    # Process NLCD for this year
+    nlcd_df = None
+    if year in nlcd_by_year:
+        nlcd_df = process_nlcd_year(year, nlcd_by_year[year])
+    
+    # Merge all data for this year (only the merged result is spilled to disk)
+    return merge_year_data(year, prism_months, mtbs_months, ndvi_months, nlcd_df, dem_df)
 
-def verify_final_output(df):
-    print("Verifying final combined DataFrame...")
+def verify_final_output(lf):
+    """Verify the final output schema and row count from a LazyFrame without materializing it."""
+    print("Verifying final combined output...")
     required_cols = ['lat', 'lon', 'year', 'month', 'ppt', 'tdmean', 'tmax', 'vpdmax', 
                      'burned_area', 'ndvi', 'landcover', 'elevation', 'slope', 'aspect']
     
-    missing = [c for c in required_cols if c not in df.columns]
+    columns = lf.collect_schema().names()
+    missing = [c for c in required_cols if c not in columns]
     if missing:
         raise ValueError(f"Missing columns in final output: {missing}")
+    
+    # Row count comes from parquet metadata, no column data is read
+    n_rows = lf.select(pl.len()).collect().item()
+    if n_rows == 0:
+        raise ValueError("Final output has no rows")
         
-    print(f"Final DataFrame shape: {df.shape}")
+    print(f"Final output columns: {len(columns)}")
+    print(f"Final output rows: {n_rows:,}")
     print("Final verification passed.")
 
+def build_file_index(vars_list):
+    """Scan the source directories and map every file to its year (and month/variable)."""
+    # PRISM files by year
+    prism_by_year = {}
+    for var in vars_list:
+        for file_path, year, month in get_prism_files(var):
+            if year not in prism_by_year:
+                prism_by_year[year] = {}
+            if month not in prism_by_year[year]:
+                prism_by_year[year][month] = {}
+            prism_by_year[year][month][var] = file_path
+    
+    # MTBS files by year
+    mtbs_by_year = {}
+    for name, path in list_nc_files(MTBS_DIR):
+        match = MTBS_PATTERN.search(name)
+        if match:
+            year = int(match.group(1))
+            if START_YEAR <= year <= END_YEAR:
+                month = int(match.group(2))
+                if year not in mtbs_by_year:
+                    mtbs_by_year[year] = {}
+                mtbs_by_year[year][month] = Path(path)
+    
+    # NDVI files by year
+    ndvi_by_year = {}
+    for name, path in list_nc_files(NDVI_DIR):
+        match = NDVI_PATTERN.search(name)
+        if match:
+            year = int(match.group(1))
+            if START_YEAR <= year <= END_YEAR:
+                month = int(match.group(2))
+                if year not in ndvi_by_year:
+                    ndvi_by_year[year] = {}
+                ndvi_by_year[year][month] = Path(path)
+    
+    # NLCD files by year (fixed-width names, so the year is sliced out directly)
+    nlcd_by_year = {}
+    for name, path in list_nc_files(NLCD_DIR, recursive=True):
+        if name.startswith(NLCD_PREFIX) and name.endswith(NLCD_SUFFIX) and len(name) == NLCD_NAME_LENGTH:
+            year_str = name[len(NLCD_PREFIX):len(NLCD_PREFIX) + 4]
+            if year_str.isdigit() and START_YEAR <= int(year_str) <= END_YEAR:
+                nlcd_by_year[int(year_str)] = Path(path)
+    
+    return {'prism': prism_by_year, 'mtbs': mtbs_by_year, 'ndvi': ndvi_by_year, 'nlcd': nlcd_by_year}
+
+def source_dir_mtimes(vars_list):
+    """Modification times of every scanned source directory (adding or removing a file bumps its parent)."""
+    dirs = [PRISM_DIR / var for var in vars_list] + [MTBS_DIR, NDVI_DIR]
+    dirs += [Path(root) for root, _, _ in os.walk(NLCD_DIR)]
+    return {d.as_posix(): os.stat(d).st_mtime for d in dirs if d.exists()}
+
+def decode_file_index(obj):
+    """Restore int year/month keys and Path values from the JSON file index."""
+    if isinstance(obj, dict):
+        return {int(k) if k.isdigit() else k: decode_file_index(v) for k, v in obj.items()}
+    return Path(obj)
+
+def load_file_index(vars_list):
+    """Return the source file index, reusing INDEX_FILE while no source directory has changed."""
+    key = {'years': [START_YEAR, END_YEAR], 'vars': vars_list, 'mtimes': source_dir_mtimes(vars_list)}
+    if INDEX_FILE.exists():
+        try:
+            cached = json.loads(INDEX_FILE.read_text())
+        except (OSError, ValueError):
+            cached = None
+        if cached and cached.get('key') == key:
+            print("Reusing cached file index.")
+            return decode_file_index(cached['index'])
+    
+    index = build_file_index(vars_list)
+    INDEX_FILE.write_text(json.dumps({'key': key, 'index': index}, default=lambda p: p.as_posix()))
+    return index
+
 def main():
     try:
         ensure_temp_dir()
@@ -315,110 +397,62 @@ def main():
         # Gather all file information first
         print("Gathering file information...")
         
-        # PRISM files by year
         vars_list = ['ppt', 'tdmean', 'tmax', 'vpdmax']
-        prism_by_year = {}
-        for var in vars_list:
-            for file_path, year, month in get_prism_files(var):
-                if year not in prism_by_year:
-                    prism_by_year[year] = {}
-                if month not in prism_by_year[year]:
-                    prism_by_year[year][month] = {}
-                prism_by_year[year][month][var] = file_path
-        
-        # MTBS files by year
-        mtbs_by_year = {}
-        pattern = re.compile(r"ca_mbts_800m_(\d{4})(\d{2})\.nc$")
-        for file_path in MTBS_DIR.glob("*.nc"):
-            match = pattern.search(file_path.name)
-            if match:
-                year = int(match.group(1))
-                if START_YEAR <= year <= END_YEAR:
-                    month = int(match.group(2))
-                    if year not in mtbs_by_year:
-                        mtbs_by_year[year] = {}
-                    mtbs_by_year[year][month] = file_path
-        
-        # NDVI files by year
-        ndvi_by_year = {}
-        pattern = re.compile(r"ca_ndvi_800m_(\d{4})-(\d{2})-(\d{2})\.nc$")
-        for file_path in NDVI_DIR.glob("*.nc"):
-            match = pattern.search(file_path.name)
-            if match:
-                year = int(match.group(1))
-                if START_YEAR <= year <= END_YEAR:
-                    month = int(match.group(2))
-                    if year not in ndvi_by_year:
-                        ndvi_by_year[year] = {}
-                    ndvi_by_year[year][month] = file_path
+        index = load_file_index(vars_list)
+        prism_by_year = index['prism']
+        mtbs_by_year = index['mtbs']
+        ndvi_by_year = index['ndvi']
+        nlcd_by_year = index['nlcd']
         
-        # NLCD files by year
-        nlcd_by_year = {}
-        pattern = re.compile(r"Annual_NLCD_LndCov_(\d{4})_CU_C1V1_800m\.nc$")
-        for file_path in NLCD_DIR.rglob("*.nc"):
-            match = pattern.search(file_path.name)
-            if match:
-                year = int(match.group(1))
-                if START_YEAR <= year <= END_YEAR:
-                    nlcd_by_year[year] = file_path
+        # Cache the shared lat/lon grid once from the first PRISM file
+        first_year = min(prism_by_year, default=None)
+        if first_year is not None:
+            first_month = min(prism_by_year[first_year])
+            _load_grid(next(iter(prism_by_year[first_year][first_month].values())))
         
         # Load DEM once (static)
         print("Loading DEM data...")
-        dem_file = load_dem()
+        dem_df = load_dem()
         print(f"DEM loaded.")
         
         # Process each year through the entire pipeline
         all_years = sorted(set(prism_by_year.keys()))
         merged_year_files = []
         
-        for year in tqdm(all_years, desc="Processing years"):
-            # Process PRISM for this year
-            prism_file = None
-            if year in prism_by_year:
-                prism_file = process_prism_year(year, prism_by_year[year], vars_list)
-            
-            if prism_file is None:
-                continue
-            
-            # Process MTBS for this year
-            mtbs_file = None
-            if year in mtbs_by_year:
-                mtbs_file = process_mtbs_year(year, mtbs_by_year[year])
-            
-            # Process NDVI for this year
-            ndvi_file = None
-            if year in ndvi_by_year:
-                ndvi_file = process_ndvi_year(year, ndvi_by_year[year])
-            
-            # Process NLCD for this year
-            nlcd_file = None
-            if year in nlcd_by_year:
-                nlcd_file = process_nlcd_year(year, nlcd_by_year[year])
-            
-            # Merge all data for this year
-            merged_file = merge_year_data(year, prism_file, mtbs_file, ndvi_file, nlcd_file, dem_file)
-            merged_year_files.append(merged_file)
-            
-            # Clean up yearly source files
-            files_to_delete = [f for f in [prism_file, mtbs_file, ndvi_file, nlcd_file] if f is not None]
-            delete_files(files_to_delete)
-        
-        # Delete DEM file
-        delete_files([dem_file])
+        # Years are independent, so run them concurrently (map keeps year order)
+        year_worker = partial(process_year, prism_by_year=prism_by_year, mtbs_by_year=mtbs_by_year,
+                              ndvi_by_year=ndvi_by_year, nlcd_by_year=nlcd_by_year,
+                              vars_list=vars_list, dem_df=dem_df)
+        max_workers = max(1, min(MAX_WORKERS, len(all_years)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for merged_file in tqdm(executor.map(year_worker, all_years), total=len(all_years), desc="Processing years"):
+                if merged_file is not None:
+                    merged_year_files.append(merged_file)
         
-        # Combine all yearly merged files
-        print(f"Combining {len(merged_year_files)} yearly merged files...")
-        combined = pl.concat([pl.scan_parquet(f) for f in merged_year_files]).collect()
+        # Leave the previous output untouched if no year produced a partition
+        if not merged_year_files or not STAGING_DIR.exists():
+            print(f"Error: No year partitions were written; keeping existing {OUTPUT_FILE}.")
+            return
+
+        # Swap the staged year-partitioned dataset in for the previous output:
+        # move the old copy aside, publish, and only then remove the old copy
+        print(f"Publishing {len(merged_year_files)} year partitions to {OUTPUT_FILE}...")
+        previous_output = TEMP_DIR / "previous_output"
+        if OUTPUT_FILE.exists():
+            os.replace(OUTPUT_FILE, previous_output)
+        try:
+            os.replace(STAGING_DIR, OUTPUT_FILE)
+        except OSError:
+            if previous_output.exists():
+                os.replace(previous_output, OUTPUT_FILE)
+            raise
+        if previous_output.is_dir():
+            shutil.rmtree(previous_output)
+        elif previous_output.exists():
+            previous_output.unlink()
         
         # Verify
-        verify_final_output(combined)
-        
-        # Save
-        print(f"Saving to {OUTPUT_FILE}...")
-        combined.write_parquet(OUTPUT_FILE)
-        
-        # Clean up merged year files
-        delete_files(merged_year_files)
+        verify_final_output(pl.scan_parquet(OUTPUT_FILE, hive_partitioning=True))
         
         print("Done!")
         
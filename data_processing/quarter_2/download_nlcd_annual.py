@@ -8,8 +8,7 @@ import geopandas as gpd
 import rioxarray as rxr
 import xarray as xr
 import numpy as np
-from scipy import stats
-from rasterio.enums import Resampling
+from numba import njit
 import shutil
 
 BASE_URL = "https://www.mrlc.gov/downloads/sciweb1/shared/mrlc/data-bundles"
@@ -22,6 +21,7 @@ PRISM_PATH = DATA_DIR / "prism_climate" / "ppt" / "ca_prism_ppt_us_30s_200001.nc
 
 # Excluded NLCD classes
 EXCLUDED_CLASSES = [11, 12, 250]  # Open Water, Perennial Snow, No Data
+NLCD_CLASSES = [c for c in [11, 12, 21, 22, 23, 24, 31, 41, 42, 43, 52, 71, 81, 82, 90, 95] if c not in EXCLUDED_CLASSES]
 
 class DownloadProgressBar(tqdm):
     def update_to(self, b=1, bsize=1, tsize=None):
@@ -68,30 +68,60 @@ def clip_to_ca_state(nlcd_path: Path, ca_state: gpd.GeoDataFrame) -> Path:
     nlcd_geo = nlcd_clipped.rio.reproject("EPSG:4326")
     return nlcd_geo
 
-def mode_statistic(values):
-    """Calculate mode (most common value) for binned_statistic_2d."""
-    if len(values) == 0:
-        return np.nan
-    # Filter out excluded classes before calculating mode
-    filtered = values[~np.isin(values, EXCLUDED_CLASSES)]
-    if len(filtered) == 0:
-        return np.nan
-    mode_result = stats.mode(filtered, keepdims=False)
-    return mode_result.mode
+@njit(nogil=True, cache=True)
+def _count_votes(values, rows, cols, class_index, width, counts):
+    """Add every on-grid pixel to counts[cell, class] in one pass; NaN votes for the missing slot."""
+    missing = counts.shape[1] - 1
+    for j in range(values.shape[0]):
+        r = rows[j]
+        if r < 0:
+            continue
+        for i in range(values.shape[1]):
+            q = cols[i]
+            if q < 0:
+                continue
+            v = values[j, i]
+            if np.isnan(v):
+                c = missing
+            else:
+                c = class_index[int(min(max(v, 0.0), 255.0))]
+            counts[r * width + q, c] += 1
 
 def upscale_to_prism(nlcd_geo, prism, output_path):
     print("Upscaling to PRISM grid")
     
-    # Mask excluded classes
-    nlcd_masked = nlcd_geo.where(~nlcd_geo.isin(EXCLUDED_CLASSES))
-    print("Masked excluded classes")
+    # Map every fine pixel centre to its PRISM cell (PRISM grid is regular, so 1-D is enough)
+    transform = prism.rio.transform()
+    height, width = prism.rio.height, prism.rio.width
+    rows = np.floor((nlcd_geo.y.values - transform.f) / transform.e).astype(np.int64)
+    cols = np.floor((nlcd_geo.x.values - transform.c) / transform.a).astype(np.int64)
+    rows[(rows < 0) | (rows >= height)] = -1
+    cols[(cols < 0) | (cols >= width)] = -1
     
-    # Reproject match to PRISM
-    nlcd_coarse = nlcd_masked.rio.reproject_match(
-        prism,
-        resampling=Resampling.mode
-    )
-    print("Reprojected to PRISM grid")
+    # Excluded classes and nodata share one extra "missing" slot, so a cell dominated by them stays NaN
+    n_classes = len(NLCD_CLASSES) + 1
+    class_index = np.full(256, n_classes - 1, dtype=np.int64)
+    class_index[NLCD_CLASSES] = np.arange(len(NLCD_CLASSES))
+    
+    # Count class votes per PRISM cell in one fused pass over the pixels
+    counts = np.zeros((height * width, n_classes), dtype=np.int64)
+    _count_votes(nlcd_geo.values[0], rows, cols, class_index, width, counts)
+    print("Counted class votes per PRISM cell")
+    
+    # Majority class per cell, NaN where the missing slot wins or no pixels fell in
+    counts = counts.reshape(height, width, n_classes)
+    winner = counts.argmax(axis=2)
+    mode = np.append(np.array(NLCD_CLASSES, dtype=np.float32), np.nan)[winner]
+    mode[counts.max(axis=2) == 0] = np.nan
+    
+    nlcd_coarse = xr.DataArray(
+        mode.reshape(prism.shape),
+        coords=prism.coords,
+        dims=prism.dims,
+        name=nlcd_geo.name
+    ).rio.write_crs(prism.rio.crs)
+    nlcd_coarse = nlcd_coarse.rio.write_nodata(np.nan, encoded=True)
+    print("Resampled to PRISM grid")
     
     # Save to NetCDF
     nlcd_coarse.to_netcdf(output_path)
@@ -1,13 +1,18 @@
 import os
+import math
+from collections import namedtuple
 from pathlib import Path
 import rioxarray as rxr
 import xarray as xr
 import numpy as np
-from scipy import stats
+from numba import njit
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import threading
+from concurrent.futures import ProcessPoolExecutor
 import geopandas as gpd
+import rasterio
+from rasterio.features import geometry_mask
+from rasterio.windows import Window, from_bounds, transform as window_transform
+import shapely
 from shapely.geometry import box
 from shapely.prepared import prep
 
@@ -17,6 +22,9 @@ INPUT_DIR = DATA_DIR / "USGS_DEM"
 OUTPUT_DIR = DATA_DIR / "ca_usgs_dem"
 PRISM_REF_PATH = DATA_DIR / "ca_prism_climate" / "ppt" / "ca_prism_ppt_us_30s_200001.nc"
 CA_STATE_PATH = DATA_DIR / "ca_state" / "ca_state.shp"
+SUM_KEYS = ('elev', 'slope', 'sx', 'sy')
+# Uniform PRISM bin grid: first edge, bin width and bin count per axis
+Grid = namedtuple('Grid', 'lon0 dx nx lat0 dy ny')
 
 def get_prism_grid(path: Path):
     if not path.exists():
@@ -24,119 +32,149 @@ def get_prism_grid(path: Path):
     prism = rxr.open_rasterio(path)
     return prism
 
-def calculate_slope_aspect_tile(dem: xr.DataArray):
+@njit(nogil=True, cache=True)
+def _slope_kernel(elev, y_coords, res_x, res_y, is_geographic, sx, sy, slope):
+    """Fused gradient/scaling/slope pass (matches np.gradient: central inside, one-sided at edges)."""
+    ny, nx = elev.shape
+    for j in range(ny):
+        # Per-row metres per unit (degrees if geographic)
+        scale_x = res_x
+        scale_y = res_y
+        if is_geographic:
+            scale_x = res_x * 111132 * np.cos(np.radians(y_coords[j]))
+            scale_y = res_y * 111132
+        
+        j0 = max(j - 1, 0)
+        j1 = min(j + 1, ny - 1)
+        for i in range(nx):
+            i0 = max(i - 1, 0)
+            i1 = min(i + 1, nx - 1)
+            gx = (elev[j, i1] - elev[j, i0]) / (i1 - i0)
+            gy = (elev[j1, i] - elev[j0, i]) / (j1 - j0)
+            sx[j, i] = gx / scale_x
+            sy[j, i] = gy / scale_y
+            slope[j, i] = np.hypot(sx[j, i], sy[j, i])
+
+def calculate_slope_aspect_tile(elev, y_coords, res_x, res_y, crs):
     """Calculate slope and aspect for a single tile (in-memory)."""
-    # Prepare Data
-    elev = dem.values
-    nodata = dem.rio.nodata
-    if nodata is not None:
-        elev = np.where(elev == nodata, np.nan, elev)
+    if min(elev.shape) < 2:
+        raise ValueError("Tile too small to compute a gradient")
     
-    # Gradient (dy, dx)
-    grad_y, grad_x = np.gradient(elev)
+    # Gradients are converted to meters if CRS is Geographic, else assumed projected meters
+    is_geographic = bool(crs.to_epsg() == 4269 or crs.is_geographic)
     
-    # Scale Gradients
-    res_x = abs(dem.rio.resolution()[0])
-    res_y = abs(dem.rio.resolution()[1])
+    # float32 outputs halve the memory traffic of the binning pass (kernel math is float64)
+    sx = np.empty(elev.shape, dtype=np.float32)
+    sy = np.empty(elev.shape, dtype=np.float32)
+    slope = np.empty(elev.shape, dtype=np.float32)
+    _slope_kernel(elev, y_coords.astype(np.float64), res_x, res_y, is_geographic, sx, sy, slope)
     
-    # Initial gradients in units per degree
-    slope_y_deg = grad_y / res_y
-    slope_x_deg = grad_x / res_x
-    
-    # Convert to meters if CRS is Geographic
-    if dem.rio.crs.to_epsg() == 4269 or dem.rio.crs.is_geographic:
-        # We need Y coords for scaling
-        Y_coords = dem.coords['y'].values
-        lat_rad = np.radians(Y_coords[:, np.newaxis])
+    return elev, slope, sx, sy
+
+def read_dem_tile(f, ca_geom, ca_prepared):
+    """
+    Read the part of a DEM tile inside CA with a rasterio windowed read.
+    Returns (elev, x_coords, y_coords, res_x, res_y, crs) with NaN outside CA/nodata, or None.
+    """
+    with rasterio.open(f) as src:
+        dem_box = box(*src.bounds)
         
-        scale_x = 111132 * np.cos(lat_rad)
-        scale_y = 111132
+        # Fast check with prepared geometry
+        if not ca_prepared.intersects(dem_box):
+            return None
+        
+        # Tiles entirely inside CA are read whole and need no masking; boundary tiles only
+        # read the window overlapping the CA bounds
+        inside = ca_prepared.contains(dem_box)
+        if inside:
+            window = Window(0, 0, src.width, src.height)
+        else:
+            ca_window = from_bounds(*ca_geom.bounds, transform=src.transform)
+            col0, row0 = math.floor(ca_window.col_off), math.floor(ca_window.row_off)
+            col1 = math.ceil(ca_window.col_off + ca_window.width)
+            row1 = math.ceil(ca_window.row_off + ca_window.height)
+            window = Window(col0, row0, col1 - col0, row1 - row0).intersection(Window(0, 0, src.width, src.height))
         
-        slope_y_m = slope_y_deg / scale_y
-        slope_x_m = slope_x_deg / scale_x
-    else:
-        # Assume projected meters
-        slope_y_m = slope_y_deg
-        slope_x_m = slope_x_deg
+        elev = src.read(1, window=window, out_dtype='float32', masked=True).filled(np.nan)
+        transform = src.window_transform(window)
+        crs = src.crs
     
-    slope = np.hypot(slope_x_m, slope_y_m)
+    if not inside:
+        # Mask pixel centres outside the CA polygon and crop to the remaining extent
+        in_ca = geometry_mask([ca_geom], out_shape=elev.shape, transform=transform, invert=True)
+        rows = np.flatnonzero(in_ca.any(axis=1))
+        cols = np.flatnonzero(in_ca.any(axis=0))
+        if rows.size == 0:
+            return None
+        row_slice = slice(rows[0], rows[-1] + 1)
+        col_slice = slice(cols[0], cols[-1] + 1)
+        elev = np.where(in_ca, elev, np.nan)[row_slice, col_slice]
+        transform = window_transform(Window(col_slice.start, row_slice.start, elev.shape[1], elev.shape[0]), transform)
     
-    return elev, slope, slope_x_m, slope_y_m
+    # Pixel-centre coordinates of the (cropped) window
+    x_coords = transform.c + (np.arange(elev.shape[1]) + 0.5) * transform.a
+    y_coords = transform.f + (np.arange(elev.shape[0]) + 0.5) * transform.e
+    return elev, x_coords, y_coords, abs(transform.a), abs(transform.e), crs
 
-def process_single_file(f, ca_geom, ca_prepared, lon_edges, lat_edges, stats_lock, accumulators):
+# Per-process worker state, set once by init_worker
+_WORKER = {}
+
+def init_worker(ca_geom_wkb, grid):
+    """Load the CA geometry and bin grid once per worker process (prepared geoms don't pickle)."""
+    ca_geom = shapely.from_wkb(ca_geom_wkb)
+    _WORKER['ca_geom'] = ca_geom
+    _WORKER['ca_prepared'] = prep(ca_geom)
+    _WORKER['grid'] = grid
+
+def process_single_file(f):
     """
     Process a single DEM file, clip to CA shape, and return the stats to accumulate.
+    Returns (y0, x0, count, sums) over the bins the tile touches (sums stacked in SUM_KEYS order), or None.
     """
+    ca_geom = _WORKER['ca_geom']
+    lon0, dx, nx, lat0, dy, ny = _WORKER['grid']
     try:
-        with rxr.open_rasterio(f, masked=True) as dem:
-            dem = dem.squeeze()
-            
-            # Clip to CA geometry
-            dem_box = box(*dem.rio.bounds())
-            
-            # Fast check with prepared geometry
-            if not ca_prepared.intersects(dem_box):
-                 return
-
-            try:
-                # Clip the DEM to the CA shape
-                clipped_dem = dem.rio.clip([ca_geom], dem.rio.crs, drop=True)
-            except Exception:
-                return
-                
-            if clipped_dem.size == 0:
-                return
-            
-            dem = clipped_dem
-            
-            # Calculate vars on the fine grid (Tile only)
-            elev, slope, sx, sy = calculate_slope_aspect_tile(dem)
-            
-            # Get coordinates
-            X_fine = dem.coords['x'].values
-            Y_fine = dem.coords['y'].values
-            Xf, Yf = np.meshgrid(X_fine, Y_fine)
-            
-            # Flatten arrays
-            elev_flat = elev.flatten()
-            slope_flat = slope.flatten()
-            sx_flat = sx.flatten()
-            sy_flat = sy.flatten()
-            lon_flat = Xf.flatten()
-            lat_flat = Yf.flatten()
-            
-            mask = ~np.isnan(elev_flat)
-            if not np.any(mask):
-                return
-            
-            lons = lon_flat[mask]
-            lats = lat_flat[mask]
-            
-            # Local accumulation for this file
-            def get_binned(values, statistic='sum'):
-                res = stats.binned_statistic_2d(
-                    lons, lats, values,
-                    statistic=statistic,
-                    bins=[lon_edges, lat_edges]
-                )
-                return np.nan_to_num(res.statistic.T)
-                
-            local_count = get_binned(None, 'count')
-            local_elev = get_binned(elev_flat[mask])
-            local_slope = get_binned(slope_flat[mask])
-            local_sx = get_binned(sx_flat[mask])
-            local_sy = get_binned(sy_flat[mask])
+        tile = read_dem_tile(f, ca_geom, _WORKER['ca_prepared'])
+        if tile is None:
+            return None
+        elev, x_coords, y_coords, res_x, res_y, crs = tile
+        
+        # Calculate vars on the fine grid (Tile only)
+        elev, slope, sx, sy = calculate_slope_aspect_tile(elev, y_coords, res_x, res_y, crs)
+        
+        # Bin index per column/row from the 1-D coords and the uniform grid, no meshgrid
+        ix_col = np.floor((x_coords - lon0) / dx).astype(np.intp)
+        iy_row = np.floor((y_coords - lat0) / dy).astype(np.intp)
+        
+        # Valid pixels: have elevation and fall inside the PRISM grid
+        valid = ~np.isnan(elev)
+        valid &= ((iy_row >= 0) & (iy_row < ny))[:, None]
+        valid &= ((ix_col >= 0) & (ix_col < nx))[None, :]
+        rows, cols = np.nonzero(valid)
+        if rows.size == 0:
+            return None
+        ix = ix_col[cols]
+        iy = iy_row[rows]
+        
+        # Only the bins this tile touches are returned, to keep results small to pickle
+        x0, y0 = ix.min(), iy.min()
+        w = ix.max() - x0 + 1
+        h = iy.max() - y0 + 1
+        flat_idx = (iy - y0) * w + (ix - x0)
+        
+        # Local accumulation for this file, (y, x) layout; count stays exact, sums go out as float32
+        count = np.bincount(flat_idx, minlength=h * w).reshape(h, w)
+        
+        def get_binned(values):
+            sums = np.bincount(flat_idx, weights=values[valid], minlength=h * w).reshape(h, w)
+            return np.nan_to_num(sums).astype(np.float32)
+        
+        sums = np.stack([get_binned(elev), get_binned(slope), get_binned(sx), get_binned(sy)])
+        return y0, x0, count, sums
             
-            # Update global accumulators
-            with stats_lock:
-                accumulators['count'] += local_count
-                accumulators['elev'] += local_elev
-                accumulators['slope'] += local_slope
-                accumulators['sx'] += local_sx
-                accumulators['sy'] += local_sy
-                
     except Exception as e:
         print(f"Warning: Failed to process {f.name}: {e}")
+        return None
 
 def verify_output(output_path: Path, prism: xr.DataArray, ca_geom: object):
     """Verify the output file matches PRISM grid and is within CA bounds."""
@@ -185,66 +223,57 @@ def main():
     # Simplify geometry for faster clipping/checking
     print("Preparing Geometry...")
     ca_geom = ca_gdf.geometry.union_all().buffer(0)
-    ca_prepared = prep(ca_geom)
     
     dx = np.abs(lonc[1] - lonc[0])
     dy = np.abs(latc[1] - latc[0])
     
-    # Create strictly increasing bin edges
+    # Strictly increasing uniform bins, computed once and shared with all workers
     x_min, x_max = min(lonc), max(lonc)
     y_min, y_max = min(latc), max(latc)
     
-    lon_edges = np.linspace(x_min - dx/2, x_max + dx/2, len(lonc) + 1)
-    lat_edges = np.linspace(y_min - dy/2, y_max + dy/2, len(latc) + 1)
+    lon0, lat0 = x_min - dx/2, y_min - dy/2
+    grid = Grid(
+        lon0=lon0, dx=(x_max + dx/2 - lon0) / len(lonc), nx=len(lonc),
+        lat0=lat0, dy=(y_max + dy/2 - lat0) / len(latc), ny=len(latc),
+    )
     
     # Initialize Accumulators (y, x)
     shape = (len(latc), len(lonc))
     
-    accumulators = {
-        'elev': np.zeros(shape, dtype=np.float64),
-        'slope': np.zeros(shape, dtype=np.float64),
-        'sx': np.zeros(shape, dtype=np.float64),
-        'sy': np.zeros(shape, dtype=np.float64),
-        'count': np.zeros(shape, dtype=np.float64)
-    }
-    stats_lock = threading.Lock()
+    acc_count = np.zeros(shape, dtype=np.int64)
+    acc_sums = np.zeros((len(SUM_KEYS),) + shape, dtype=np.float32)
     
-    # Process Files
-    dem_files = list(INPUT_DIR.glob("*.tif"))
+    # Process Files (largest first so the long tiles don't trail at the end)
+    dem_files = sorted(INPUT_DIR.glob("*.tif"), key=lambda f: f.stat().st_size, reverse=True)
     if not dem_files:
         print(f"No .tif files found in {INPUT_DIR}")
         return
     
-    with tqdm(total=len(dem_files), desc="Processing Tiles", unit="tile") as pbar:
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = []
-            for f in dem_files:
-                future = executor.submit(process_single_file, f, ca_geom, ca_prepared, lon_edges, lat_edges, stats_lock, accumulators)
-                future.add_done_callback(lambda _: pbar.update(1))
-                futures.append(future)
-            
-            for future in as_completed(futures):
-                 pass
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                             initargs=(shapely.to_wkb(ca_geom), grid)) as executor:
+        results = executor.map(process_single_file, dem_files, chunksize=4)
+        for result in tqdm(results, total=len(dem_files), desc="Processing Tiles", unit="tile"):
+            if result is None:
+                continue
+            y0, x0, count, sums = result
+            h, w = count.shape
+            acc_count[y0:y0 + h, x0:x0 + w] += count
+            acc_sums[:, y0:y0 + h, x0:x0 + w] += sums
+    accumulators = dict(zip(SUM_KEYS, acc_sums))
 
     # Finalize Aggregation
     print("Finalizing...")
-    acc_count = accumulators['count']
     valid = acc_count > 0
     
-    fin_elev = np.full(shape, np.nan)
-    fin_slope = np.full(shape, np.nan)
-    fin_sx = np.full(shape, np.nan)
-    fin_sy = np.full(shape, np.nan)
-    
-    # Compute Means
-    fin_elev[valid] = accumulators['elev'][valid] / acc_count[valid]
-    fin_slope[valid] = accumulators['slope'][valid] / acc_count[valid]
-    fin_sx[valid] = accumulators['sx'][valid] / acc_count[valid]
-    fin_sy[valid] = accumulators['sy'][valid] / acc_count[valid]
+    # Compute Means (single pass each; cells without samples stay NaN)
+    means = {}
+    for key in SUM_KEYS:
+        means[key] = np.full(shape, np.nan, dtype=np.float32)
+        np.divide(accumulators[key], acc_count, out=means[key], where=valid)
+    fin_elev, fin_slope, fin_sx, fin_sy = (means[key] for key in SUM_KEYS)
     
-    # Compute Aspect from Mean Vector
-    fin_sx = np.where(np.isclose(fin_sx, 0, atol=1e-12), 1e-3, fin_sx)
-    fin_aspect = np.arctan2(fin_sy, fin_sx)
+    # Compute Aspect from Mean Vector (in place, sx is not needed afterwards; arctan2 is defined for sx == 0)
+    fin_aspect = np.arctan2(fin_sy, fin_sx, out=fin_sx)
     
     # Handle Orientation Flip
     if latc[1] < latc[0]:
@@ -7,7 +7,11 @@ from tqdm import tqdm
 import numpy as np
 from shapely.geometry import mapping
 import rasterio
-from datetime import datetime, timedelta
+from pyproj import Transformer
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import threading
 
 # Constants
 DATA_DIR = Path(__file__).resolve().parent.parent / "data"
@@ -15,22 +19,82 @@ INPUT_DIR = DATA_DIR / "nasa_ndvi"
 OUTPUT_DIR = DATA_DIR / "ca_nasa_ndvi"
 PRISM_REF_PATH = DATA_DIR / "prism_climate" / "ppt" / "ca_prism_ppt_us_30s_200001.nc"
 CA_STATE_PATH = DATA_DIR / "ca_state" / "ca_state.shp"
+# Format: MOD13A3.061__1_km_monthly_NDVI_doy2000032000000_aid0001.tif
+DOY_PATTERN = re.compile(r"_doy(\d{4})(\d{3})")
+# CA geometries reprojected per raster CRS (keyed by WKT)
+_CA_GEOMS = {}
+CA_GEOMS_LOCK = threading.Lock()
+# Files regridded together in one clip + regrid pass
+BATCH_SIZE = 12
+# Nearest-neighbour regrid plans per clipped source grid
+_REGRID_PLANS = {}
+REGRID_PLANS_LOCK = threading.Lock()
 
-def process_file(file_path: Path, reference_grid: xr.DataArray, ca_state: gpd.GeoDataFrame, output_dir: Path):
+def ca_geometries(ca_state: gpd.GeoDataFrame, crs):
+    """
+    Return the CA polygons as GeoJSON-like mappings in the given CRS.
+    Reprojection and mapping() run once per CRS; MODIS tiles all share one.
+    """
+    key = crs.to_wkt()
+    with CA_GEOMS_LOCK:
+        if key not in _CA_GEOMS:
+            ca_state_proj = ca_state.to_crs(crs) if ca_state.crs != crs else ca_state
+            _CA_GEOMS[key] = [mapping(geom) for geom in ca_state_proj.geometry]
+        return _CA_GEOMS[key]
+
+def parse_ndvi_dates(input_files):
+    """
+    Parse acquisition dates from MODIS filenames in one vectorized pass.
+    Returns a list of "YYYY-MM-DD" strings (None where the name does not match).
+    """
+    matches = [DOY_PATTERN.search(f.name) for f in input_files]
+    parsed = np.array([(int(m.group(1)), int(m.group(2))) if m else (0, 0) for m in matches], dtype=np.int64).reshape(-1, 2)
+    years, doys = parsed[:, 0], parsed[:, 1]
+    valid = (years >= 2000) & (years <= 2024) & (doys >= 1)
+    
+    # Year start + (doy - 1) days
+    dates = (years - 1970).astype("datetime64[Y]").astype("datetime64[D]") + (doys - 1).astype("timedelta64[D]")
+    date_strs = np.datetime_as_string(dates, unit="D")
+    return [d if ok else None for d, ok in zip(date_strs.tolist(), valid)]
+
+def regrid_plan(clipped: xr.DataArray, reference_grid: xr.DataArray):
+    """
+    Return (template, rows, cols, inside) for nearest-neighbour regridding of
+    this source grid onto the reference grid. Each reference cell center is
+    projected once into the source CRS and mapped to the pixel it falls in;
+    every file on the same grid reuses the lookup. template is a one-band
+    reproject_match result that carries the output coords and metadata.
+    """
+    key = (clipped.rio.crs.to_wkt(), tuple(clipped.rio.transform()), clipped.shape[-2:])
+    with REGRID_PLANS_LOCK:
+        if key not in _REGRID_PLANS:
+            template = clipped.isel(band=[0]).rio.reproject_match(
+                reference_grid,
+                resampling=rasterio.enums.Resampling.nearest
+            )
+            
+            # Reference cell centers -> source pixel indices
+            transformer = Transformer.from_crs(reference_grid.rio.crs, clipped.rio.crs, always_xy=True)
+            x, y = np.meshgrid(template.x.values, template.y.values)
+            cols, rows = ~clipped.rio.transform() * transformer.transform(x, y)
+            rows = np.floor(rows).astype(np.intp)
+            cols = np.floor(cols).astype(np.intp)
+            inside = (rows >= 0) & (rows < clipped.shape[-2]) & (cols >= 0) & (cols < clipped.shape[-1])
+            _REGRID_PLANS[key] = (template, rows[inside], cols[inside], inside)
+        return _REGRID_PLANS[key]
+
+def process_file(file_path: Path, date_str: str, reference_grid: xr.DataArray, ca_state: gpd.GeoDataFrame, output_dir: Path):
     """
     Process a single NDVI file: clip to California and regrid to match reference grid.
     """
     try:
+        if date_str is None:
+            raise ValueError(f"Filename {file_path.name} does not match expected MODIS format.")
+        
         rds = rioxarray.open_rasterio(file_path, masked=True)
         
-        # Ensure we have the right CRS for the vector before clipping
-        if ca_state.crs != rds.rio.crs:
-            ca_state_proj = ca_state.to_crs(rds.rio.crs)
-        else:
-            ca_state_proj = ca_state
-
-        # Clip to California
-        clipped = rds.rio.clip(ca_state_proj.geometry.apply(mapping), ca_state_proj.crs)
+        # Clip to California (geometries already in the raster CRS)
+        clipped = rds.rio.clip(ca_geometries(ca_state, rds.rio.crs), rds.rio.crs)
 
         # Reproject/Regrid to match PRISM grid
         regridded = clipped.rio.reproject_match(
@@ -38,21 +102,6 @@ def process_file(file_path: Path, reference_grid: xr.DataArray, ca_state: gpd.Ge
             resampling=rasterio.enums.Resampling.nearest
         )
         
-        # Construct output filename
-        # Format: MOD13A3.061__1_km_monthly_NDVI_doy2000032000000_aid0001.tif
-        parts = file_path.name.split('_')
-        doy_part = [p for p in parts if p.startswith('doy')][0]
-        if doy_part:
-            date_part = doy_part[3:10] # 2000032
-            year = int(date_part[0:4])
-            if year < 2000 or year > 2024:
-                raise ValueError(f"Filename {file_path.name} does not match expected MODIS format.")
-            doy = int(date_part[4:])
-            date_obj = datetime(year, 1, 1) + timedelta(days=doy - 1)
-            date_str = date_obj.strftime("%Y-%m-%d")
-        else:
-            raise ValueError(f"Filename {file_path.name} does not match expected MODIS format.")
-        
         output_filename = f"ca_ndvi_800m_{date_str}.nc"
         output_path = output_dir / output_filename
         
@@ -62,6 +111,64 @@ def process_file(file_path: Path, reference_grid: xr.DataArray, ca_state: gpd.Ge
     except Exception as e:
         print(f"Error processing {file_path.name}: {e}")
 
+def process_batch(batch, reference_grid: xr.DataArray, ca_state: gpd.GeoDataFrame, output_dir: Path):
+    """
+    Process single-band NDVI files that share one raster grid: stack them along the band
+    dimension (slice i is file i), clip the whole stack once, then regrid each slice with the
+    grid's cached nearest-neighbour lookup.
+    batch is a list of (file_path, date_str) tuples; falls back to
+    process_file per file if the stacked path fails.
+    """
+    try:
+        rds = xr.concat(
+            [rioxarray.open_rasterio(file_path, masked=True) for file_path, _ in batch],
+            dim="band"
+        )
+        
+        # Clip to California (geometries already in the raster CRS)
+        clipped = rds.rio.clip(ca_geometries(ca_state, rds.rio.crs), rds.rio.crs)
+
+        # Regrid to match PRISM grid with the cached nearest-neighbour lookup
+        template, rows, cols, inside = regrid_plan(clipped, reference_grid)
+        values = clipped.values
+        
+        # Save each file's slice to NetCDF
+        for i, (file_path, date_str) in enumerate(batch):
+            regridded = np.full(template.shape, np.nan, dtype=template.dtype)
+            regridded[0][inside] = values[i][rows, cols]
+            output_path = output_dir / f"ca_ndvi_800m_{date_str}.nc"
+            template.copy(data=regridded).to_netcdf(output_path)
+        
+    except Exception as e:
+        print(f"Error processing batch starting at {batch[0][0].name}: {e}; falling back to per-file processing")
+        for file_path, date_str in batch:
+            process_file(file_path, date_str, reference_grid, ca_state, output_dir)
+
+def make_batches(input_files, dates):
+    """
+    Group valid single-band files by raster grid (CRS, transform, shape) and
+    split each group into batches of at most BATCH_SIZE.
+    Files with unparseable dates or more than one band are returned as
+    single-file batches, since process_batch maps stack slice i to file i.
+    """
+    groups = {}
+    singles = []
+    for file_path, date_str in zip(input_files, dates):
+        if date_str is None:
+            singles.append([(file_path, date_str)])
+            continue
+        with rasterio.open(file_path) as src:
+            if src.count != 1:
+                singles.append([(file_path, date_str)])
+                continue
+            key = (src.crs.to_wkt() if src.crs else None, tuple(src.transform), src.shape)
+        groups.setdefault(key, []).append((file_path, date_str))
+    
+    batches = []
+    for group in groups.values():
+        batches.extend(group[i:i + BATCH_SIZE] for i in range(0, len(group), BATCH_SIZE))
+    return batches, singles
+
 def verify_outputs(output_dir: Path, reference_grid: xr.DataArray):
     """
     Verify all generated files in output_dir.
@@ -133,9 +240,19 @@ def main():
     max_workers = 5
     num_workers = min(max_workers, total_files)
 
-    print("Processing files...")
-    for file_path in tqdm(input_files):
-        process_file(file_path, prism_ref, ca_state, OUTPUT_DIR)
+    # Parse all acquisition dates up front
+    dates = parse_ndvi_dates(input_files)
+
+    # Files on the same grid are regridded together
+    batches, singles = make_batches(input_files, dates)
+    for batch in singles:
+        process_file(*batch[0], prism_ref, ca_state, OUTPUT_DIR)
+
+    # GDAL reads/warps release the GIL; prism_ref and ca_state are only read
+    print(f"Processing {len(batches)} batches with {num_workers} workers...")
+    worker = partial(process_batch, reference_grid=prism_ref, ca_state=ca_state, output_dir=OUTPUT_DIR)
+    with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+        list(tqdm(executor.map(worker, batches), total=len(batches)))
 
     verify_outputs(OUTPUT_DIR, prism_ref)
 
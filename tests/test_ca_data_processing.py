@@ -25,19 +25,3 @@ def test_ca_cleanup_temp_dir():
     
     cleanup_temp_dir()
     assert not TEMP_DIR.exists(), "Temp dir should be successfully removed"
-
-def test_ca_delete_files(tmp_path):
-    """Verify delete_files correctly removes files when provided a list."""
-    from combine_dataset import delete_files
-    
-    f1 = tmp_path / "ca_dummy1.txt"
-    f2 = tmp_path / "ca_dummy2.txt"
-    f1.touch()
-    f2.touch()
-    
-    assert f1.exists() and f2.exists()
-    
-    delete_files([f1, f2])
-    
-    assert not f1.exists()
-    assert not f2.exists()
@@ -0,0 +1,121 @@
+import pytest
+import numpy as np
+from pathlib import Path
+import importlib.util
+import os
+import sys
+import tempfile
+import numba
+from rasterio.crs import CRS
+
+# Both quarters have a process_dem_data.py, so each is loaded under its own module name.
+# numba's on-disk cache records the module name, so the kernels compile into a throwaway
+# cache dir rather than the __pycache__ used when the scripts run normally
+NUMBA_CACHE = tempfile.TemporaryDirectory()
+os.environ["NUMBA_CACHE_DIR"] = NUMBA_CACHE.name
+numba.config.reload_config()
+
+DATA_PROCESSING_DIR = Path(__file__).resolve().parent.parent / "data_processing"
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+ca_dem = load_module("ca_process_dem_data", DATA_PROCESSING_DIR / "quarter_2" / "process_dem_data.py")
+
+def reference_slope(elev, y_coords, res_x, res_y, is_geographic):
+    """The np.gradient slope the numba kernel replaced."""
+    grad_y, grad_x = np.gradient(elev.astype(np.float64))
+    slope_y = grad_y / res_y
+    slope_x = grad_x / res_x
+    if is_geographic:
+        lat_rad = np.radians(y_coords[:, np.newaxis])
+        slope_y = slope_y / 111132
+        slope_x = slope_x / (111132 * np.cos(lat_rad))
+    return np.hypot(slope_x, slope_y), slope_x, slope_y
+
+def synthetic_elevation(shape=(7, 9)):
+    """Random elevation block with NaN cells inside and on the edges."""
+    rng = np.random.default_rng(0)
+    elev = (rng.random(shape) * 500).astype(np.float32)
+    elev[0, 4] = np.nan
+    elev[3, 0] = np.nan
+    elev[3, 5] = np.nan
+    elev[-1, -1] = np.nan
+    return elev
+
+@pytest.mark.parametrize("epsg, is_geographic", [(4269, True), (3310, False)])
+def test_ca_slope_kernel_matches_np_gradient(epsg, is_geographic):
+    """Verify the quarter_2 slope kernel matches np.gradient, including edge cells and NaN neighbourhoods."""
+    elev = synthetic_elevation()
+    y_coords = 33.0 - np.arange(elev.shape[0]) * 0.01
+    res_x, res_y = (0.01, 0.01) if is_geographic else (30.0, 30.0)
+
+    _, slope, sx, sy = ca_dem.calculate_slope_aspect_tile(elev, y_coords, res_x, res_y, CRS.from_epsg(epsg))
+    expected = reference_slope(elev, y_coords, res_x, res_y, is_geographic)
+
+    for result, ref in zip((slope, sx, sy), expected):
+        np.testing.assert_array_equal(np.isnan(result), np.isnan(ref))
+        np.testing.assert_allclose(result, ref, rtol=1e-5, atol=1e-12, equal_nan=True)
+
+def test_ca_slope_tile_too_small():
+    """Verify a single-row tile is rejected rather than given a bogus gradient."""
+    with pytest.raises(ValueError):
+        ca_dem.calculate_slope_aspect_tile(np.zeros((1, 5), dtype=np.float32), np.zeros(1), 1.0, 1.0, CRS.from_epsg(3310))
+
+sd_dem = load_module("sd_process_dem_data", DATA_PROCESSING_DIR / "quarter_1" / "process_dem_data.py")
+
+def reference_upscale(lonf, latf, data, lon_edges, lat_edges):
+    """The binned_statistic_2d mean of the valid cells that the accumulation kernel replaced."""
+    from scipy import stats
+    mask = ~np.isnan(data)
+    ret = stats.binned_statistic_2d(lonf[mask], latf[mask], data[mask], statistic='mean', bins=[lon_edges, lat_edges])
+    return ret.statistic.T
+
+@pytest.mark.parametrize("n_chunks", [1, 3])
+def test_sd_accumulate_kernel_matches_binned_statistic(n_chunks):
+    """Verify the quarter_1 accumulation kernel gives binned_statistic_2d means, including NaN cells and edge bins."""
+    rng = np.random.default_rng(1)
+    lon_edges = np.linspace(-117.0, -116.0, 5)
+    lat_edges = np.linspace(32.5, 33.25, 4)
+    nx, ny = len(lon_edges) - 1, len(lat_edges) - 1
+    
+    # Fine coordinates include points off the grid, on the first edge, on inner edges
+    # and on the last edge (which binned_statistic_2d closes on the right)
+    x_fine = np.concatenate([[-117.1, -117.0, -116.75, -116.5], rng.uniform(-117.0, -116.0, 8), [-116.0, -115.9]])
+    y_fine = np.concatenate([[33.3, 33.25, 33.0], rng.uniform(32.5, 33.25, 6), [32.75, 32.5, 32.4]])
+    
+    # float32 blocks as in process_upscaling; a NaN row, a NaN column and one all-NaN coarse cell
+    blocks = tuple((rng.random((y_fine.size, x_fine.size)) * 100).astype(np.float32) for _ in range(2))
+    blocks[0][2, :] = np.nan
+    blocks[1][5, 3] = np.nan
+    blocks[1][:, 6] = np.nan
+    ix = sd_dem.bin_indices(x_fine, lon_edges)
+    iy = sd_dem.bin_indices(y_fine, lat_edges)
+    blocks[1][np.ix_(iy == 0, ix == 0)] = np.nan
+    sums = np.zeros((len(blocks), nx * ny))
+    counts = np.zeros((len(blocks), nx * ny), dtype=np.int64)
+    
+    # Two row blocks, as process_upscaling streams them
+    split = 7
+    for rows in (slice(0, split), slice(split, None)):
+        sd_dem._accumulate_kernel(tuple(b[rows] for b in blocks), ix, iy[rows], nx, n_chunks, sums, counts)
+    
+    lonf, latf = np.meshgrid(x_fine, y_fine)
+    for k, block in enumerate(blocks):
+        result = sd_dem.upscale_variable(sums[k], counts[k], nx, ny)
+        expected = reference_upscale(lonf.ravel(), latf.ravel(), block.ravel(), lon_edges, lat_edges)
+        assert result.shape == (ny, nx)
+        if k == 1:
+            assert np.isnan(result[0, 0]), "All-NaN coarse cell should stay NaN"
+        np.testing.assert_array_equal(np.isnan(result), np.isnan(expected))
+        np.testing.assert_allclose(result, expected, rtol=1e-12, equal_nan=True)
+
+def test_sd_bin_indices_edges():
+    """Verify bin_indices marks off-grid coordinates with -1 and puts the last edge in the last bin."""
+    edges = np.linspace(0.0, 1.0, 5)
+    coords = np.array([-0.1, 0.0, 0.25, 0.999, 1.0, 1.1])
+    np.testing.assert_array_equal(sd_dem.bin_indices(coords, edges), [-1, 0, 1, 3, 3, -1])